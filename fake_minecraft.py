@@ -0,0 +1,184 @@
+#
+# Local stand-in for the Minecraft API server (Raspberry Jam / mcpi), to test and time block output without Minecraft
+#
+
+import socket
+import socketserver
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+###############
+# DEFINITIONS #
+###############
+
+# protocol: one command per line, e.g. "world.setBlocks(0,64,0,9,68,0,1)". Commands that set something get no reply,
+# queries (player.getPos, world.getBlock, ...) get one line back. This is the protocol mcpi and Raspberry Jam speak
+
+# round trip: a query, the client has to wait for its reply before going on
+
+# delay: time the server spends on every command, like Minecraft applying it to the world. latency: time before the
+# reply of a query gets back to the client, like the network and the game tick in between
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# delay – seconds per command
+# latency – seconds per round trip
+# drop_every – commands after which the server drops the connection (0 never), to test reconnecting clients
+
+
+class FakeMinecraft:
+
+    def __init__(self, host="localhost", port=0, delay=0.0, latency=0.0, player=(0, 64, 0), drop_every=0,
+                 direction=(0, 0, 1)):
+        self.delay = delay
+        self.latency = latency
+        self.drop_every = drop_every
+        self.player = tuple(player)
+        self.direction = tuple(direction)
+
+        # (x, y, z) -> block of everything that was set
+        self.world = {}
+
+        # Commands received, by name, queries answered, connections accepted and dropped on purpose
+        self.commands = Counter()
+        self.round_trips = 0
+        self.connections = 0
+        self.drops = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                with server.lock:
+                    server.connections += 1
+                received = 0
+                for line in self.rfile:
+                    received += 1
+                    if server.drop_every and received > server.drop_every:
+                        with server.lock:
+                            server.drops += 1
+                        return
+                    reply = server.execute(line.decode("utf8").strip())
+                    if reply is not None:
+                        self.wfile.write((reply + "\n").encode("utf8"))
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-minecraft", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.world = {}
+            self.commands = Counter()
+            self.round_trips = 0
+            self.connections = 0
+            self.drops = 0
+
+    # Total number of commands received
+    def total(self):
+        return sum(self.commands.values())
+
+    # Apply one command line. Return the reply, or None if the command has none
+    def execute(self, line):
+        if not line:
+            return None
+        name, _, args = line.partition("(")
+        args = [a for a in args.rstrip(")").split(",") if a != ""]
+        if self.delay:
+            time.sleep(self.delay)
+
+        with self.lock:
+            self.commands[name] += 1
+            if name == "world.setBlock":
+                x, y, z = (int(float(a)) for a in args[:3])
+                self.world[(x, y, z)] = tuple(int(a) for a in args[3:])
+            elif name == "world.setBlocks":
+                x0, y0, z0, x1, y1, z1 = (int(float(a)) for a in args[:6])
+                block = tuple(int(a) for a in args[6:])
+                for x in range(min(x0, x1), max(x0, x1) + 1):
+                    for y in range(min(y0, y1), max(y0, y1) + 1):
+                        for z in range(min(z0, z1), max(z0, z1) + 1):
+                            self.world[(x, y, z)] = block
+            elif name in ("player.getPos", "player.getTile"):
+                reply = ",".join(str(v) for v in self.player)
+            elif name == "player.getDirection":
+                reply = ",".join(str(v) for v in self.direction)
+            elif name == "world.getBlock":
+                reply = str(self.world.get(tuple(int(float(a)) for a in args[:3]), (0,))[0])
+            else:
+                # chat.post, camera commands, ... are only counted
+                return None
+
+            if name.startswith("world.set"):
+                return None
+            self.round_trips += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        return reply
+
+
+# Client of the same protocol, sending every command with a write of its own the way mcpi does. Has the part of the
+# mcpi Minecraft object the block output uses (setBlock, setBlocks, postToChat, player.getPos, player.getDirection)
+class Client:
+
+    def __init__(self, address):
+        self.socket = socket.create_connection(address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.socket.makefile("rb")
+        self.player = _Player(self)
+
+    def send(self, name, *args):
+        self.socket.sendall("{}({})\n".format(name, ",".join(str(a) for a in args)).encode("utf8"))
+
+    def query(self, name, *args):
+        self.send(name, *args)
+        return self.file.readline().decode("utf8").strip()
+
+    def setBlock(self, x, y, z, *block):
+        self.send("world.setBlock", int(x), int(y), int(z), *block)
+
+    def setBlocks(self, x0, y0, z0, x1, y1, z1, *block):
+        self.send("world.setBlocks", int(x0), int(y0), int(z0), int(x1), int(y1), int(z1), *block)
+
+    def postToChat(self, msg):
+        self.send("chat.post", msg)
+
+    # Wait until the server applied everything sent so far (it answers queries in order)
+    def sync(self):
+        self.query("player.getPos")
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+class _Player:
+
+    def __init__(self, client):
+        self.client = client
+
+    # Position with x, y and z like the Vec3 of mcpi
+    def getPos(self):
+        x, y, z = (float(v) for v in self.client.query("player.getPos").split(","))
+        return SimpleNamespace(x=x, y=y, z=z)
+
+    # Unit vector of the direction the player looks in, with x, y and z like the Vec3 of mcpi
+    def getDirection(self):
+        x, y, z = (float(v) for v in self.client.query("player.getDirection").split(","))
+        return SimpleNamespace(x=x, y=y, z=z)
@@ -0,0 +1,424 @@
+#
+# One persistent, pipelined connection to the Minecraft API (Raspberry Jam / mcpi protocol)
+#
+
+import argparse
+import socket
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+import fake_minecraft
+
+###############
+# DEFINITIONS #
+###############
+
+# pipelining: commands that set something (setBlock, setBlocks, chat) get no reply, so they are queued and sent by a
+# writer thread without waiting for anything. Only queries (player.getPos, ...) wait, for their own reply
+
+# batch: the commands waiting in the queue are joined and sent with one write, up to (self.batch_bytes) bytes and as
+# many commands as are left until the next checkpoint
+
+# checkpoint: a query sent after the commands, once its reply is back the server applied all of them (it works through
+# the commands in order). Commands written since the last checkpoint are unconfirmed, a dropped connection may have
+# lost them. The writer sends a checkpoint every (self.checkpoint_lines) commands, and every query is one too
+
+# reconnect: when a write fails or a query gets no reply, the connection is opened again, waiting (self.backoff)
+# seconds before the first try and twice as long after every failed one, up to (self.max_backoff). The unconfirmed
+# setBlock and setBlocks commands are sent again on the new connection followed by a checkpoint, and nothing new is
+# sent before its reply is back. Setting blocks twice doesn't change the world. Other commands (chat) are never sent
+# twice, so they can be lost with the connection. If the unconfirmed commands still don't go through after
+# (self.max_resends) connections, they are given up on and counted as lost, so a server that keeps dropping the
+# connection can't stall the queue forever
+
+# closing: close waits up to (timeout) seconds for the queued commands to be applied. Whatever is still queued after
+# that is dropped and counted as discarded, and the reconnect attempts stop
+
+# rate: commands sent per second over the last (self.rate_window) seconds
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# self.max_queue – commands that can wait in the queue, a full queue makes the caller wait up to self.timeout
+# self.batch_bytes – largest write
+# self.checkpoint_lines – commands between two checkpoints, and at most sent again after a reconnect
+# self.max_resends – connections the unconfirmed commands are sent again on before they are given up on
+# self.backoff, self.max_backoff – seconds between reconnect attempts
+# self.report_every – seconds between two messages about failed connection attempts
+# self.timeout – seconds a query, a full queue or close wait for the server
+
+
+# Query used as checkpoint
+CHECKPOINT = b"player.getPos()\n"
+
+# Commands that can be sent again after a reconnect without changing the result
+IDEMPOTENT = b"world.setBlock"
+
+
+# Whether a deadline (time.monotonic() value, or None for none) has passed
+def expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+# Seconds left until a deadline, or None for none
+def remaining(deadline):
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+class Connection:
+
+    def __init__(self, host="localhost", port=4711, max_queue=10000, batch_bytes=65536, checkpoint_lines=1000,
+                 max_resends=3, backoff=0.1, max_backoff=5.0, timeout=10.0):
+        self.address = (host, port)
+        self.max_queue = max_queue
+        self.batch_bytes = batch_bytes
+        self.checkpoint_lines = checkpoint_lines
+        self.max_resends = max_resends
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.report_every = 30.0
+        self.rate_window = 5.0
+
+        self.socket = None
+        self.file = None
+
+        # Encoded command lines waiting for the writer, and the number of lines it is sending right now
+        self.queue = deque()
+        self.sending = 0
+        self.condition = threading.Condition()
+
+        # Held while writing, so a query doesn't write in the middle of a batch
+        self.write_lock = threading.Lock()
+
+        # setBlock and setBlocks lines written since the last checkpoint, and the number of lines of any command
+        self.unconfirmed = []
+        self.unconfirmed_lines = 0
+
+        # Totals since the start: commands sent, batches, connections lost, failed connection attempts, unconfirmed
+        # commands given up on, queued commands dropped by close. (time, commands) of the last batches for the rate
+        self.sent = 0
+        self.batches = 0
+        self.reconnects = 0
+        self.connect_failures = 0
+        self.lost = 0
+        self.discarded = 0
+        self.history = deque()
+
+        # Time of the last message about failed connection attempts
+        self.last_report = None
+
+        # Set by close, also cuts the backoff waits short
+        self.closed = False
+        self.wake = threading.Event()
+
+        self.player = _Player(self)
+        self.thread = threading.Thread(target=self.run, name="minecraft-writer", daemon=True)
+        self.thread.start()
+
+    # Open the connection, trying again with backoff until it works, the deadline passes or the connection is closed
+    def connect(self, deadline=None):
+        delay = self.backoff
+        while not self.closed and not expired(deadline):
+            try:
+                self.socket = socket.create_connection(self.address, timeout=self.timeout)
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.file = self.socket.makefile("rb")
+                self.last_report = None
+                return True
+            except OSError as e:
+                self.connect_failures += 1
+                now = time.monotonic()
+                if self.last_report is None or now - self.last_report >= self.report_every:
+                    print("Could not connect to Minecraft at {}:{} ({}), still trying ({} failed attempts)".format(
+                        self.address[0], self.address[1], e, self.connect_failures))
+                    self.last_report = now
+                left = remaining(deadline)
+                self.wake.wait(delay if left is None else min(delay, left))
+                delay = min(delay * 2, self.max_backoff)
+        return False
+
+    def disconnect(self):
+        if self.socket is not None:
+            try:
+                self.file.close()
+                self.socket.close()
+            except OSError:
+                pass
+        self.socket = None
+        self.file = None
+
+    # Forget the connection after it failed
+    def drop(self):
+        self.disconnect()
+        self.reconnects += 1
+
+    def clear_unconfirmed(self):
+        self.unconfirmed = []
+        self.unconfirmed_lines = 0
+
+    # Open a new connection and get the unconfirmed commands applied on it before anything else is sent. Called with
+    # write_lock held. Return False if no connection could be opened
+    def reconnect(self, deadline=None):
+        attempts = 0
+        while True:
+            if not self.connect(deadline):
+                return False
+            if not self.unconfirmed:
+                self.clear_unconfirmed()
+                return True
+            if attempts >= self.max_resends:
+                print("Giving up on {} commands the Minecraft API never confirmed".format(len(self.unconfirmed)))
+                self.lost += len(self.unconfirmed)
+                self.clear_unconfirmed()
+                return True
+
+            attempts += 1
+            try:
+                self.socket.sendall(b"".join(self.unconfirmed) + CHECKPOINT)
+                reply = self.file.readline()
+            except OSError:
+                reply = b""
+            if reply:
+                self.clear_unconfirmed()
+                return True
+            self.drop()
+
+    # Write data, reconnecting until it went through. Called with write_lock held. Return False if it couldn't be
+    # written before the deadline or before the connection was closed
+    def write(self, data, deadline=None):
+        while not self.closed and not expired(deadline):
+            if self.socket is None and not self.reconnect(deadline):
+                return False
+            try:
+                self.socket.sendall(data)
+                return True
+            except OSError:
+                self.drop()
+        return False
+
+    # Write a query and return its reply, which also confirms everything written before it. Called with write_lock
+    # held. Return None if there was no reply before the deadline or before the connection was closed
+    def round_trip(self, line, deadline=None):
+        while not self.closed and not expired(deadline):
+            if not self.write(line, deadline):
+                break
+            try:
+                reply = self.file.readline()
+            except OSError:
+                reply = b""
+            if reply:
+                self.clear_unconfirmed()
+                return reply.decode("utf8").strip()
+
+            # The connection went away before the reply came, ask again on a new one
+            self.drop()
+        return None
+
+    # Writer thread: send the queued commands in batches
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                # Only as many lines as fit before the next checkpoint, so no more than self.checkpoint_lines are
+                # ever unconfirmed. Only this thread adds to unconfirmed_lines, a query may have cleared it meanwhile
+                room = max(1, self.checkpoint_lines - self.unconfirmed_lines)
+                lines = []
+                size = 0
+                while self.queue and len(lines) < room and (
+                        not lines or size + len(self.queue[0]) <= self.batch_bytes):
+                    line = self.queue.popleft()
+                    lines.append(line)
+                    size += len(line)
+                self.sending = len(lines)
+                self.condition.notify_all()
+
+            with self.write_lock:
+                written = self.write(b"".join(lines))
+                if written:
+                    self.unconfirmed.extend(line for line in lines if line.startswith(IDEMPOTENT))
+                    self.unconfirmed_lines += len(lines)
+                    if self.unconfirmed_lines >= self.checkpoint_lines:
+                        self.round_trip(CHECKPOINT)
+
+            with self.condition:
+                self.sending = 0
+                if written:
+                    self.sent += len(lines)
+                    self.batches += 1
+                    self.history.append((time.time(), len(lines)))
+                else:
+                    self.discarded += len(lines)
+                self.condition.notify_all()
+
+    # Queue a command that has no reply. Raise ConnectionError if the connection is closed, or if the queue stayed full
+    # for self.timeout seconds
+    def send(self, name, *args):
+        line = "{}({})\n".format(name, ",".join(str(a) for a in args)).encode("utf8")
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while len(self.queue) >= self.max_queue and not self.closed:
+                if expired(deadline):
+                    raise ConnectionError("the Minecraft API at {}:{} took no command for {:.0f}s".format(
+                        self.address[0], self.address[1], self.timeout))
+                self.condition.wait(remaining(deadline))
+            if self.closed:
+                raise ConnectionError("the connection to the Minecraft API is closed")
+            self.queue.append(line)
+            self.condition.notify_all()
+
+    # Wait until every queued command was written, or until timeout seconds passed. Return whether it was
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while (self.queue or self.sending) and self.thread.is_alive():
+                if expired(deadline):
+                    return False
+                self.condition.wait(remaining(deadline))
+            return not (self.queue or self.sending)
+
+    # Wait until the server applied everything queued so far, or until timeout seconds passed. Return whether it did
+    def sync(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self.flush(timeout):
+            return False
+        if not self.write_lock.acquire(timeout=-1 if deadline is None else remaining(deadline)):
+            return False
+        try:
+            return self.unconfirmed_lines == 0 or self.round_trip(CHECKPOINT, deadline) is not None
+        finally:
+            self.write_lock.release()
+
+    # Send a query after everything queued before it, and return its reply. Raise ConnectionError if there was no reply
+    # within self.timeout seconds
+    def query(self, name, *args):
+        deadline = time.monotonic() + self.timeout
+        line = "{}({})\n".format(name, ",".join(str(a) for a in args)).encode("utf8")
+        reply = None
+        if self.flush(self.timeout) and self.write_lock.acquire(timeout=remaining(deadline)):
+            try:
+                reply = self.round_trip(line, deadline)
+            finally:
+                self.write_lock.release()
+        if reply is None:
+            raise ConnectionError("no reply to {} from the Minecraft API at {}:{}".format(
+                name, self.address[0], self.address[1]))
+        with self.condition:
+            self.sent += 1
+        return reply
+
+    def setBlock(self, x, y, z, *block):
+        self.send("world.setBlock", int(x), int(y), int(z), *block)
+
+    def setBlocks(self, x0, y0, z0, x1, y1, z1, *block):
+        self.send("world.setBlocks", int(x0), int(y0), int(z0), int(x1), int(y1), int(z1), *block)
+
+    def postToChat(self, msg):
+        self.send("chat.post", msg)
+
+    # Commands waiting to be sent
+    def queue_depth(self):
+        with self.condition:
+            return len(self.queue) + self.sending
+
+    # Commands sent per second over the last rate_window seconds
+    def rate(self):
+        now = time.time()
+        with self.condition:
+            while self.history and now - self.history[0][0] > self.rate_window:
+                self.history.popleft()
+            if not self.history:
+                return 0
+            return sum(n for _, n in self.history) / self.rate_window
+
+    def stats(self):
+        return {"sent": self.sent, "batches": self.batches, "reconnects": self.reconnects,
+                "connect_failures": self.connect_failures, "lost": self.lost, "discarded": self.discarded,
+                "queue_depth": self.queue_depth(), "commands_per_second": self.rate()}
+
+    # Wait up to timeout seconds (self.timeout by default) for the server to apply everything queued, then drop what is
+    # left and close the connection. Return whether everything was applied
+    def close(self, timeout=None):
+        applied = self.sync(self.timeout if timeout is None else timeout)
+        with self.condition:
+            self.closed = True
+            self.discarded += len(self.queue)
+            self.queue.clear()
+            self.condition.notify_all()
+        self.wake.set()
+        self.thread.join(timeout=self.timeout)
+        if self.write_lock.acquire(timeout=self.timeout):
+            try:
+                self.disconnect()
+            finally:
+                self.write_lock.release()
+        return applied
+
+
+class _Player:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    # Position with x, y and z like the Vec3 of mcpi
+    def getPos(self):
+        x, y, z = (float(v) for v in self.connection.query("player.getPos").split(","))
+        return SimpleNamespace(x=x, y=y, z=z)
+
+    # Unit vector of the direction the player looks in, with x, y and z like the Vec3 of mcpi
+    def getDirection(self):
+        x, y, z = (float(v) for v in self.connection.query("player.getDirection").split(","))
+        return SimpleNamespace(x=x, y=y, z=z)
+
+
+# Place blocks one by one against the fake server, asking for the player position before every block like placeBlock
+# did, then the same blocks through a Connection. Print the blocks per second of both
+def benchmark(blocks=2000, latency=0.02, drop_every=0):
+    server = fake_minecraft.FakeMinecraft(latency=latency).start()
+    host, port = server.address
+    try:
+        # Request/response: one round trip per block
+        each = max(1, min(blocks, int(2 / latency) if latency else blocks))
+        mc = fake_minecraft.Client(server.address)
+        start = time.perf_counter()
+        for i in range(each):
+            pos = mc.player.getPos()
+            mc.setBlock(pos.x + i % 100, pos.y + i // 10000, pos.z + i // 100 % 100, 1)
+        mc.sync()
+        elapsed = time.perf_counter() - start
+        mc.close()
+        print("request/response: {} blocks in {:.2f}s, {:.0f} blocks/s".format(each, elapsed, each / elapsed))
+
+        # Pipelined: one round trip for the position, then only writes
+        server.reset()
+        server.drop_every = drop_every
+        connection = Connection(host, port)
+        start = time.perf_counter()
+        pos = connection.player.getPos()
+        for i in range(blocks):
+            connection.setBlock(pos.x + i % 100, pos.y + i // 10000, pos.z + i // 100 % 100, 1)
+        connection.sync()
+        elapsed = time.perf_counter() - start
+        stats = connection.stats()
+        connection.close()
+        print("pipelined: {} blocks in {:.2f}s, {:.0f} blocks/s, {} batches, {} reconnects, {} lost, {} blocks in the "
+              "world".format(blocks, elapsed, blocks / elapsed, stats["batches"], stats["reconnects"], stats["lost"],
+                             len(server.world)))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=2000, help="blocks to place")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per round trip of the fake server")
+    parser.add_argument("--drop-every", type=int, default=0,
+                        help="make the fake server drop the connection after this many commands, to test reconnects")
+    args = parser.parse_args()
+
+    benchmark(args.blocks, args.latency, args.drop_every)
@@ -0,0 +1,183 @@
+#
+# Plans the block output of a structure as a few bulk setBlocks commands instead of one setBlock per block
+#
+
+import argparse
+import math
+import random
+import time
+import numpy as np
+import fake_minecraft
+
+###############
+# DEFINITIONS #
+###############
+
+# voxels: the structure to build, as a dict of (x, y, z) world coordinates -> block. A block is a block id or a tuple
+# of block id and data, the way mcpi takes them
+
+# cuboid: axis-aligned box of voxels of the same block, built with one setBlocks command
+
+# merging: greedy, going through the voxels bottom up (y, then z, then x). The first voxel not built yet starts a
+# cuboid, which is grown along x as far as the voxels have the same block, then along z as long as the whole row is
+# there, then along y as long as the whole layer is there. Every voxel ends up in exactly one cuboid. This is not
+# always the fewest cuboids possible, but walls, floors and solid blocks come out as a single command
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# --delay – seconds the fake server spends on every command in the benchmark
+
+
+# Block of a voxel as the tuple of arguments mcpi takes after the coordinates
+def block_args(block):
+    return tuple(block) if isinstance(block, (tuple, list)) else (block,)
+
+
+# Merge voxels into cuboids. Return a list of ((x0, y0, z0), (x1, y1, z1), block) with inclusive corners
+def merge_cuboids(voxels):
+    if not voxels:
+        return []
+
+    # Dense grid of the bounding box, with the index of the block of every voxel (0 for empty)
+    coords = np.array(list(voxels.keys()), dtype=np.int64)
+    low = coords.min(axis=0)
+    size = coords.max(axis=0) - low + 1
+    blocks = []
+    ids = {}
+    grid = np.zeros(size, dtype=np.int32)
+    for (x, y, z), block in voxels.items():
+        key = block_args(block)
+        if key not in ids:
+            blocks.append(key)
+            ids[key] = len(blocks)
+        grid[x - low[0], y - low[1], z - low[2]] = ids[key]
+
+    todo = grid != 0
+    cuboids = []
+
+    # Bottom up, then along z, then along x
+    order = np.argwhere(todo.transpose(1, 2, 0))
+    for y, z, x in order:
+        if not todo[x, y, z]:
+            continue
+        label = grid[x, y, z]
+
+        def fits(x0, x1, y0, y1, z0, z1):
+            return np.all(todo[x0:x1, y0:y1, z0:z1] & (grid[x0:x1, y0:y1, z0:z1] == label))
+
+        x1 = x + 1
+        while x1 < size[0] and fits(x1, x1 + 1, y, y + 1, z, z + 1):
+            x1 += 1
+        z1 = z + 1
+        while z1 < size[2] and fits(x, x1, y, y + 1, z1, z1 + 1):
+            z1 += 1
+        y1 = y + 1
+        while y1 < size[1] and fits(x, x1, y1, y1 + 1, z, z1):
+            y1 += 1
+
+        todo[x:x1, y:y1, z:z1] = False
+        cuboids.append(((int(x + low[0]), int(y + low[1]), int(z + low[2])),
+                        (int(x1 - 1 + low[0]), int(y1 - 1 + low[1]), int(z1 - 1 + low[2])), blocks[label - 1]))
+
+    return cuboids
+
+
+# Build the cuboids with one command each. Return the number of commands sent
+def build_cuboids(mc, cuboids):
+    for (x0, y0, z0), (x1, y1, z1), block in cuboids:
+        if (x0, y0, z0) == (x1, y1, z1):
+            mc.setBlock(x0, y0, z0, *block)
+        else:
+            mc.setBlocks(x0, y0, z0, x1, y1, z1, *block)
+    return len(cuboids)
+
+
+# Build voxels with as few commands as merging gives. Return the number of commands sent
+def build(mc, voxels):
+    return build_cuboids(mc, merge_cuboids(voxels))
+
+
+# Build voxels with one setBlock each, the way placeBlock and the turtle do. Return the number of commands sent
+def build_each(mc, voxels):
+    for (x, y, z), block in voxels.items():
+        mc.setBlock(x, y, z, *block_args(block))
+    return len(voxels)
+
+
+# Voxels of topcode rows and columns, built in front of the player at pos (anything with x, y, z) and to the right as
+# the columns increase, the same as placeBlock in top_codes.py
+def topcode_voxels(direction, rows, cols, pos, offset=0, blocktype=1, vert_disp=0):
+    voxels = {}
+    for r, c in zip(rows, cols):
+        if direction == 'xp':
+            voxel = (pos.x + 1, pos.y + r + vert_disp, pos.z + c - offset)
+        elif direction == 'xn':
+            voxel = (pos.x - 1, pos.y + r + vert_disp, pos.z - c + offset)
+        elif direction == 'zp':
+            voxel = (pos.x - c + offset, pos.y + r + vert_disp, pos.z + 1)
+        else:
+            voxel = (pos.x + c - offset, pos.y + r + vert_disp, pos.z - 1)
+
+        # Minecraft rounds block coordinates down
+        voxels[tuple(math.floor(v) for v in voxel)] = blocktype
+    return voxels
+
+
+# Structures for the benchmark: stone walls with a glass top like usertest.py builds, a solid cube, a topcode grid with
+# some holes and a scattered cloud that doesn't merge much
+def sample_structures(seed=0):
+    rng = random.Random(seed)
+    structures = {}
+
+    walls = {}
+    for y in range(5):
+        for i in range(30):
+            for p in [(i, y, 0), (i, y, 29), (0, y, i), (29, y, i)]:
+                walls[p] = 1 if y < 4 else 20
+    structures["walls 30x30x5"] = walls
+
+    structures["cube 16"] = {(x, y, z): 1 for x in range(16) for y in range(16) for z in range(16)}
+
+    grid = {(c, r, 0): 57 for r in range(9) for c in range(9) if rng.random() < 0.8}
+    structures["topcodes 9x9"] = grid
+
+    structures["scattered 500"] = {(rng.randrange(40), rng.randrange(10), rng.randrange(40)): rng.choice([1, 4, 5])
+                                   for _ in range(500)}
+    return structures
+
+
+# Build every sample structure both ways against the fake server and print the commands and the seconds until
+# the server applied them
+def benchmark(delay=0.0005):
+    server = fake_minecraft.FakeMinecraft(delay=delay).start()
+    print("{:16} {:>7} {:>10} {:>10} {:>10} {:>10}".format("structure", "blocks", "each cmds", "each s",
+                                                          "merged cmds", "merged s"))
+    try:
+        for name, voxels in sample_structures().items():
+            row = [name, len(voxels)]
+            worlds = []
+            for method in (build_each, build):
+                server.reset()
+                mc = fake_minecraft.Client(server.address)
+                start = time.perf_counter()
+                method(mc, voxels)
+                mc.sync()
+                row += [server.total() - 1, time.perf_counter() - start]
+                worlds.append(server.world)
+                mc.close()
+
+            if worlds[0] != worlds[1]:
+                print("{}: the merged build differs from the block by block one".format(name))
+            print("{:16} {:>7} {:>10} {:>10.3f} {:>10} {:>10.3f}".format(*row))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.0005, help="seconds the fake server spends on every command")
+    args = parser.parse_args()
+
+    benchmark(args.delay)
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import pytest
+from videoTest import benchmark
+from videoTest import calibration
+from videoTest import contourUtil
+
+
+# Synthetic board at the resolution the Board sees, and the index sets of its blocks away from the border
+def synthetic_board(seed, board):
+    img, centers = benchmark.synthetic_frame((1280, 720), 6, seed)
+    ps, qs, valid = board.get_centers(centers)
+    border = board.rows // board.border_ratio
+    keep = valid & (ps > border) & (qs > border)
+    return cv2.resize(img, (640, 360)), set(zip(ps[keep].tolist(), qs[keep].tolist()))
+
+
+# Index sets a surface scan keeps, starting from a block everywhere
+def scanned(board, img):
+    board.top[:] = 1
+    board.surface_level(img)
+    return set(map(tuple, np.argwhere(board.top > 0).tolist()))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_calibrated_board_finds_blocks(seed, tmp_path):
+    img, _ = synthetic_board(seed, contourUtil.Board(np.zeros((360, 640, 3), np.uint8), side_length=36))
+    cal, calibrator = calibration.load_calibration(str(tmp_path / "calibration.json"), "video.mp4", (640, 360))
+    calibrator.images = [img]
+    calibrator.run()
+
+    # The blocks of the synthetic frames are 25 pixels wide at this resolution
+    assert cal.side_length == 25
+    board = cal.board(img)
+    _, blocks = synthetic_board(seed, board)
+    assert blocks and scanned(board, img) == blocks
+
+    # The next start sets up the same board from the file
+    loaded = calibration.load(str(tmp_path / "calibration.json"))[calibrator.key]
+    assert scanned(loaded.board(img), img) == blocks
+
+
+def test_default_board_finds_blocks():
+    board = calibration.Calibration((640, 360)).board(np.zeros((360, 640, 3), np.uint8))
+    img, blocks = synthetic_board(2, board)
+    assert board.side_length == calibration.DEFAULT_SIDE_LENGTH
+    assert len(blocks) == 6 and scanned(board, img) == blocks
+
+
+# The corners are given in the mirrored view, so the calibrator of a rectified board measures the blocks of that side
+def test_rectified_board_measured_mirrored(tmp_path):
+    img = np.full((360, 640, 3), 40, np.uint8)
+    for y in range(60, 300, 60):
+        for x in range(40, 280, 60):
+            cv2.rectangle(img, (x, y), (x + 20, y + 20), (255, 255, 255), -1)
+            cv2.rectangle(img, (640 - x - 30, y), (640 - x, y + 30), (255, 255, 255), -1)
+
+    cal, calibrator = calibration.load_calibration(str(tmp_path / "calibration.json"), "video.mp4", (640, 360))
+    cal.corners = np.float32([[0, 0], [320, 0], [320, 360], [0, 360]])
+    calibrator.mirrored = True
+    calibrator.samples = calibrator.every = 1
+    calibrator.offer(img)
+    calibrator.join()
+
+    # The left half of the mirrored view is the right half of the frame, where the blocks are 30 pixels wide
+    assert cal.measured_width == 30
@@ -0,0 +1,39 @@
+import threading
+import numpy as np
+from videoTest import metrics
+
+
+# Stages and counters added by one thread while another one exports and draws the HUD, like the tracking and render
+# stages of the pipeline
+def test_export_while_stages_are_added(tmp_path):
+    m = metrics.Metrics(str(tmp_path / "metrics.prom"), hud=True)
+    img = np.zeros((10, 10, 3), np.uint8)
+    done = threading.Event()
+    errors = []
+
+    def add():
+        for i in range(5000):
+            with m.stage("stage{}".format(i)):
+                pass
+            m.count("counter{}".format(i))
+            m.gauge("gauge{}".format(i), i)
+        done.set()
+
+    def export():
+        try:
+            while not done.is_set():
+                m.to_prometheus()
+                m.to_dict()
+                m.draw_hud(img)
+        except Exception as e:
+            errors.append(e)
+            done.set()
+
+    threads = [threading.Thread(target=add), threading.Thread(target=export)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert len(m.to_dict()["stages"]) == 5000
@@ -0,0 +1,100 @@
+import socket
+import time
+import fake_minecraft
+import minecraft_connection
+import pytest
+
+
+def closed_port():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def place(connection, blocks):
+    for i in range(blocks):
+        connection.setBlock(i % 100, 64 + i // 10000, i // 100 % 100, 1)
+
+
+# Connection that keeps the most commands it ever had to send again after a reconnect
+class ResendCounter(minecraft_connection.Connection):
+
+    def __init__(self, *args, **kwargs):
+        self.most_unconfirmed = 0
+        super().__init__(*args, **kwargs)
+
+    def reconnect(self, deadline=None):
+        self.most_unconfirmed = max(self.most_unconfirmed, self.unconfirmed_lines)
+        return super().reconnect(deadline)
+
+
+# The writer is held back until every block is queued, so the batches always come out the same: about 300 commands
+# (batch_bytes), which don't add up to checkpoint_lines. The resend after a drop stays within drop_every, so every
+# block gets through however often the server drops the connection
+@pytest.mark.parametrize("drop_every", [0, 550, 700, 1500, 5000])
+def test_every_block_arrives(drop_every):
+    server = fake_minecraft.FakeMinecraft(drop_every=drop_every).start()
+    connection = ResendCounter(*server.address, checkpoint_lines=500, batch_bytes=8000)
+    try:
+        with connection.write_lock:
+            place(connection, 6000)
+        assert connection.close()
+    finally:
+        server.stop()
+
+    stats = connection.stats()
+    assert len(server.world) == 6000
+    assert stats["lost"] == 0 and stats["discarded"] == 0
+    assert connection.most_unconfirmed <= 500
+    assert (server.drops > 0) == (drop_every > 0)
+
+    # One checkpoint per batch at most, plus one per reconnect
+    assert server.round_trips <= 6000 // 500 + 2 * server.drops + 2
+
+
+def test_chat_is_not_sent_twice():
+    server = fake_minecraft.FakeMinecraft(drop_every=600).start()
+    connection = minecraft_connection.Connection(*server.address, checkpoint_lines=500)
+    try:
+        connection.postToChat("building")
+        place(connection, 3000)
+        connection.close()
+    finally:
+        server.stop()
+
+    assert server.commands["chat.post"] <= 1
+    assert len(server.world) == 3000
+
+
+def test_query_after_pipelined_commands():
+    server = fake_minecraft.FakeMinecraft(player=(5, 70, -2)).start()
+    connection = minecraft_connection.Connection(*server.address)
+    try:
+        place(connection, 100)
+        pos = connection.player.getPos()
+
+        # The query waits for the commands queued before it
+        assert len(server.world) == 100
+        assert (pos.x, pos.y, pos.z) == (5, 70, -2)
+        assert server.round_trips == 1
+
+        direction = connection.player.getDirection()
+        assert (direction.x, direction.y, direction.z) == (0, 0, 1)
+        connection.close()
+    finally:
+        server.stop()
+
+
+def test_server_down():
+    connection = minecraft_connection.Connection("localhost", closed_port(), timeout=0.5, max_queue=10)
+    with pytest.raises(ConnectionError):
+        place(connection, 100)
+    with pytest.raises(ConnectionError):
+        connection.player.getPos()
+
+    start = time.perf_counter()
+    assert not connection.close()
+    assert time.perf_counter() - start < 3
+    assert connection.stats()["discarded"] >= 10
@@ -0,0 +1,69 @@
+import random
+import fake_minecraft
+import minecraft_placement
+import pytest
+from types import SimpleNamespace
+
+
+@pytest.fixture
+def server():
+    server = fake_minecraft.FakeMinecraft().start()
+    yield server
+    server.stop()
+
+
+def random_voxels(seed, n=400, size=12):
+    rng = random.Random(seed)
+    return {(rng.randrange(size), rng.randrange(size), rng.randrange(size)): rng.choice([1, 4, (35, 14)])
+            for _ in range(n)}
+
+
+def cuboid_voxels(cuboid):
+    (x0, y0, z0), (x1, y1, z1), _ = cuboid
+    return [(x, y, z) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) for z in range(z0, z1 + 1)]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_cuboids_cover_voxels_exactly_once(seed):
+    voxels = random_voxels(seed)
+    covered = {}
+    for cuboid in minecraft_placement.merge_cuboids(voxels):
+        for voxel in cuboid_voxels(cuboid):
+            assert voxel not in covered
+            covered[voxel] = cuboid[2]
+
+    assert covered == {v: minecraft_placement.block_args(b) for v, b in voxels.items()}
+
+
+def test_solid_shapes_merge_into_one_cuboid():
+    cube = {(x, y, z): 1 for x in range(5) for y in range(3) for z in range(4)}
+    assert minecraft_placement.merge_cuboids(cube) == [((0, 0, 0), (4, 2, 3), (1,))]
+    assert minecraft_placement.merge_cuboids({}) == []
+
+
+def build_world(server, method, voxels):
+    server.reset()
+    mc = fake_minecraft.Client(server.address)
+    method(mc, voxels)
+    mc.sync()
+    mc.close()
+
+    # The sync query isn't part of the build
+    return dict(server.world), server.total() - 1
+
+
+@pytest.mark.parametrize("name", sorted(minecraft_placement.sample_structures()))
+def test_build_matches_block_by_block(server, name):
+    voxels = minecraft_placement.sample_structures()[name]
+    each_world, each_commands = build_world(server, minecraft_placement.build_each, voxels)
+    world, commands = build_world(server, minecraft_placement.build, voxels)
+
+    assert world == each_world
+    assert each_commands == len(voxels)
+    assert commands < each_commands
+
+
+def test_topcode_voxels_round_down():
+    pos = SimpleNamespace(x=-3.5, y=64.2, z=10.7)
+    voxels = minecraft_placement.topcode_voxels('zn', [0, 0, 1], [0, 1, 2], pos, offset=1.0)
+    assert sorted(voxels) == [(-5, 64, 9), (-4, 64, 9), (-3, 65, 9)]
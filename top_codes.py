@@ -16,51 +16,176 @@ from ws4py.server.wsgiutils import WebSocketWSGIApplication
 import threading
 import json
 import sys
+import numpy as np
+import minecraft_placement
+import minecraft_connection
+
+
+# Latest scan of every client, kept as the raw message. Scanner clients send a scan for every camera frame, but only
+# the one before "confirm" is built, so the others are never parsed. Newer scans replace older ones (latest wins)
+class LatestStore:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = {}
+
+        # Scans received, and scans replaced before they were confirmed
+        self.received = 0
+        self.replaced = 0
+
+    def put(self, client, raw):
+        with self.lock:
+            if client in self.latest:
+                self.replaced += 1
+            self.latest[client] = raw
+            self.received += 1
+
+    # Raw latest scan of a client, or None if it hasn't sent one
+    def get(self, client):
+        with self.lock:
+            return self.latest.get(client)
+
+    def discard(self, client):
+        with self.lock:
+            self.latest.pop(client, None)
+
+
+# Builds confirmed scans on a thread of its own, so a slow build never holds up the messages. Only the latest confirmed
+# scan waits for the build that is running, an older one still waiting is dropped
+class BuildWorker:
+
+    def __init__(self, build):
+        self.build = build
+        self.condition = threading.Condition()
+        self.pending = None
+        self.dropped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="build", daemon=True)
+        self.thread.start()
+
+    # Hand a raw scan to the worker, it is parsed there
+    def submit(self, raw):
+        with self.condition:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = raw
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                raw, self.pending = self.pending, None
+
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                print("Ignoring a scan that isn't valid JSON")
+                continue
+            try:
+                self.build(data)
+            except Exception as e:
+                print("Build failed: {}".format(e))
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+store = LatestStore()
+worker = None
+
+# Connection to Minecraft (Raspberry Jam listens on port 4711), kept open for all the builds
+mc = None
+
+# Block id of block.DIAMOND_ORE in mcpi, the block the topcodes are built with unless an option says otherwise
+DIAMOND_ORE = 56
 
 
-prev_data = {}
 class WS(WebSocket):
     def received_message(self, message):
         message = message.data
 
         if len(message) > 0:
-            message = str(message.decode('utf8'))
+            if isinstance(message, bytes):
+                message = message.decode('utf8')
 
             if message == "confirm":
-                processTopCodes(prev_data)
+                raw = store.get(self)
+                if raw is not None:
+                    worker.submit(raw)
             else:
-                prev_data = json.loads(message)
+                store.put(self, message)
+
+    def closed(self, code, reason=None):
+        store.discard(self)
 
 def quit():
     sys.exit()
 
-# def calculate_direction1(mc):
-#     x_dir = mc.player.getDirection().x
-#     z_dir = mc.player.getDirection().z
-#     if fabs(x_dir) > fabs(z_dir):
-#         if x_dir > 0:
-#             player_dir = 'xp'
-#         else:
-#             player_dir = 'xn'
-#     else:
-#         if z_dir > 0:
-#             player_dir = 'zp'
-#         else:
-#             player_dir = 'zn'
-
-#     return player_dir
-
-def sortxFn(t):
-    return t['x']
-
-def sortyFn(t):
-    return t['y']
-
-def same_row(t1, t2, rad):
-    return abs(t1['y'] - t2['y']) < 2*rad # if closer than 2 radius distance away
-
-def same_column(t1, t2, rad):
-    return abs(t1['x'] - t2['x']) < 2*rad # if closer than 2 radius distance away
+# Direction the player faces, as the axis ('x' or 'z') the view is closest to, followed by 'p' for positive or 'n'
+# for negative
+def calculate_direction(mc):
+    direction = mc.player.getDirection()
+    if abs(direction.x) > abs(direction.z):
+        if direction.x > 0:
+            player_dir = 'xp'
+        else:
+            player_dir = 'xn'
+    else:
+        if direction.z > 0:
+            player_dir = 'zp'
+        else:
+            player_dir = 'zn'
+
+    return player_dir
+
+# x, y and radius of every topcode as one (n, 3) array, leaving the topcode dicts as they are
+def topcode_array(topcodes):
+    return np.array([(t['x'], t['y'], t['radius']) for t in topcodes], dtype=np.float64).reshape(-1, 3)
+
+# Cluster values that are closer than tol into groups numbered in increasing order of value. Same as going through the
+# values in increasing order, starting a new group at every value that isn't in a group yet and putting every value
+# closer than tol to it into that group (even values that were in an earlier group already), but in O(n log n):
+# - the values starting a group ("seeds") are found by jumping from one seed to the first value at least tol above it
+# - a value ends up in the group of the last seed closer than tol to it
+def sweep_clusters(values, tol):
+    values = np.asarray(values, dtype=np.float64)
+    order = np.sort(values)
+    n = len(order)
+
+    seeds = []
+    i = 0
+    while i < n:
+        seed = order[i]
+        seeds.append(seed)
+        i = int(np.searchsorted(order, seed + tol, side='left'))
+
+        # Make the jump agree with the abs(a - b) < tol test of the values themselves
+        while i > 0 and order[i - 1] - seed >= tol and order[i - 1] > seed:
+            i -= 1
+        while i < n and order[i] - seed < tol:
+            i += 1
+    seeds = np.array(seeds)
+
+    # Last seed closer than tol, found by binary search then checked against the neighbouring seeds the same way
+    groups = np.searchsorted(seeds, values + tol, side='left') - 1
+    groups = np.clip(groups, 0, len(seeds) - 1)
+    up = np.minimum(groups + 1, len(seeds) - 1)
+    groups = np.where((up > groups) & (np.abs(seeds[up] - values) < tol), up, groups)
+    groups = np.where((groups > 0) & (np.abs(seeds[groups] - values) >= tol), groups - 1, groups)
+    return groups
+
+# Row and column of every topcode of an (n, 3) array of x, y and radius. Rows are counted from the bottom (largest y)
+# and columns from the left, and two topcodes are in the same row (column) if closer than 2 radius distance away
+def cluster_rows_columns(codes, rad):
+    rows = sweep_clusters(-codes[:, 1], 2 * rad)
+    cols = sweep_clusters(codes[:, 0], 2 * rad)
+    return rows, cols
 
 
 def processTopCodes(data):
@@ -69,6 +194,7 @@ def processTopCodes(data):
         return
 
     vert_disp = 0
+    blocktype = DIAMOND_ORE
     options = data['options']
 
     # TODO: This code checks if the block type is in the list that is supported 
@@ -82,52 +208,16 @@ def processTopCodes(data):
     # currently only polling for 9x9 grid
     direction = calculate_direction(mc)
     rad = topcodes[0]['radius'] # assuming all radii are similar size
-    bottom_sorted = list(sorted(topcodes, key=sortyFn))
-    bottom_sorted.reverse()
-    left_sorted = list(sorted(topcodes, key=sortxFn))
-    bottom = bottom_sorted[0]['y']
-    left = left_sorted[0]['x']
-    right = left_sorted[-1]['x']
-    top = bottom_sorted[-1]['y']
-
-    curr_row = -1
-    curr_col = -1
-
-    # first assign rows
-    for t in bottom_sorted:
-        # mc.postToChat(t)
-        if 'r' in t: 
-            # already given row value
-            continue
-
-        curr_row += 1
-        t_samerow = [t_ for t_ in bottom_sorted if same_row(t, t_, rad)]
-
-        # t_samerow should include t
-        for t_ in t_samerow:    
-            t_['r'] = curr_row
-    
-    for t in left_sorted:
-        if 'c' in t:
-            continue
-
-        curr_col += 1
-        t_samecol = [t_ for t_ in left_sorted if same_column(t, t_, rad)]
-
-        # t_samecol should include t
-        for t_ in t_samecol:
-            t_['c'] = curr_col
 
-    offset = max([t['c'] for t in topcodes]) / 2
+    # assign rows and columns
+    rows, cols = cluster_rows_columns(topcode_array(topcodes), rad)
 
-    for t in topcodes:
-        # mc.postToChat(t)
-        if 'c' not in t or 'r' not in t:
-            mc.postToChat("Problem")
-            mc.postToChat(t)
-            break
+    offset = cols.max() / 2
 
-        placeBlock(direction, t['r'], t['c'], mc, offset = offset, blocktype = blocktype, vert_disp = vert_disp)
+    # one setBlocks per cuboid of blocks instead of one setBlock per topcode
+    voxels = minecraft_placement.topcode_voxels(direction, rows.tolist(), cols.tolist(), mc.player.getPos(),
+                                                offset = offset, blocktype = blocktype, vert_disp = vert_disp)
+    minecraft_placement.build(mc, voxels)
 
     mc.postToChat('complete')
 
@@ -150,6 +240,9 @@ def top_codes_loop():
     server.serve_forever()
 
 def main():
+    global worker, mc
+    mc = minecraft_connection.Connection('localhost', 4711)
+    worker = BuildWorker(processTopCodes)
     top_codes_thread = threading.Thread(target=top_codes_loop)
     top_codes_thread.start()
 
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+# Solve the assignment problem: pick at most one column for every row and at most one row for every column so that
+# every row (or every column, if there are more rows than columns) is matched and the total cost is minimal.
+# Hungarian algorithm with potentials, O(n^2 m) for n rows and m columns (n <= m).
+# Return the matched rows and columns as two arrays of the same length
+def linear_assignment(cost):
+    cost = np.asarray(cost, dtype=np.float64)
+
+    # The algorithm needs at least as many columns as rows
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+
+    n, m = cost.shape
+    if n == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    # Potentials of the rows and the columns. Index 0 is a dummy used by the algorithm, real rows and columns start at 1
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+
+    # Row assigned to each column (0 if none) and the column visited before each column on the augmenting path
+    p = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+
+        # Grow the augmenting path until it reaches a free column
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+
+            # Reduced cost of row i0 against every column
+            cur = cost[i0 - 1] - u[i0] - v[1:]
+            free = ~used[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+
+            j0 = j1
+            if p[j0] == 0:
+                break
+
+        # Flip the assignments along the augmenting path
+        while j0 != 0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.flatnonzero(p[1:])
+    rows = p[1:][cols] - 1
+
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+    if transposed:
+        order = np.argsort(cols)
+        return cols[order], rows[order]
+    return rows, cols
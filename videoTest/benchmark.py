@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import sys
+import time
+import cv2
+import numpy as np
+from videoTest import contourUtil
+from videoTest import grabDetection
+from videoTest import landmarkCache
+
+###############
+# DEFINITIONS #
+###############
+
+# scenario: one resolution of the synthetic footage with one number of blocks on the board
+
+# stage: one step of the frame loop timed on its own (see STAGES)
+
+# baseline: JSON file with the percentiles of an earlier run. A stage regresses when its median is more than
+# (tolerance * 100)% and more than (min_ms) ms slower than in the baseline. BASELINE is the one saved in the repository,
+# recorded on a single core x86 Linux machine without a GPU. Timings depend on the hardware, so save a baseline of your
+# own with --save-baseline before comparing on another machine
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# RESOLUTIONS – camera resolutions of the synthetic footage (before get_half_dimensions)
+# BLOCK_COUNTS – blocks placed on the board
+# --frames – frames timed per scenario
+# --tolerance – allowed relative slowdown before a stage counts as a regression
+# --min-ms – allowed absolute slowdown, so the noise of stages that take a fraction of a millisecond doesn't count
+
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+BLOCK_COUNTS = [10, 50, 200]
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+STAGES = ["resize", "color", "hands", "tracker", "get_center", "get_centers", "get_contours", "get_contours_hough",
+          "surface_level", "surface_level_one_block", "overlay"]
+
+# Block side length at the camera resolution. Frames are halved before processing, so the board sees blocks of
+# SIDE_LENGTH // 2, the hard-coded side length of contourUtil.Board
+SIDE_LENGTH = 72
+
+# Bright colours, so the blocks stay above the threshold of get_contours once converted to gray
+COLORS = [(255, 255, 255), (80, 220, 255), (120, 255, 120), (255, 200, 120), (200, 200, 255)]
+
+
+# Make a frame of a textured table with (blocks) coloured squares placed on the cells of the grid
+# Return the frame and the centers of the blocks at half resolution
+def synthetic_frame(resolution, blocks, seed=0):
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+
+    img = rng.integers(30, 90, size=(height, width, 3), dtype=np.uint8)
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+
+    cols = width // SIDE_LENGTH
+    rows = height // SIDE_LENGTH
+    cells = rng.permutation(rows * cols)[:blocks]
+
+    # Blocks are smaller than a cell so that they don't touch each other
+    size = int(SIDE_LENGTH * 0.7)
+    margin = (SIDE_LENGTH - size) // 2
+
+    centers = []
+    for k, cell in enumerate(cells):
+        r, c = divmod(int(cell), cols)
+        x0 = c * SIDE_LENGTH + margin
+        y0 = r * SIDE_LENGTH + margin
+        cv2.rectangle(img, (x0, y0), (x0 + size, y0 + size), COLORS[k % len(COLORS)], -1)
+        centers.append(((x0 + size / 2) / 2, (y0 + size / 2) / 2))
+
+    return img, np.array(centers, dtype=np.float32).reshape(-1, 2)
+
+
+# Make the landmarks of a hand with its wrist at (x, y), either pinching or open
+def synthetic_hand(x, y, scale, pinching, rng):
+    # Rough shape of a right hand pointing up: the wrist, then 4 joints per finger from the thumb to the pinky
+    shape = [(0, 0)]
+    for f, dx in enumerate([-0.6, -0.25, 0, 0.25, 0.5]):
+        for j in range(1, 5):
+            shape.append((dx * (1 + 0.2 * j), -0.3 * j - (0 if f == 0 else 0.5)))
+    pts = np.array(shape, dtype=np.float32) * scale + (x, y)
+
+    if pinching:
+        # Bring the thumb tip onto the index fingertip and fold the thumb
+        pts[4] = pts[8] + rng.normal(0, 2, 2)
+        pts[3] = pts[2] + (scale * 0.1, 0)
+
+    return pts + rng.normal(0, 1, pts.shape).astype(np.float32)
+
+
+# Make the hand detections of (num_frames) frames with two hands moving around and pinching now and then
+def synthetic_detections(num_frames, dsize, seed=0):
+    rng = np.random.default_rng(seed)
+    width, height = dsize
+    wrists = np.array([[width * 0.3, height * 0.7], [width * 0.7, height * 0.7]], dtype=np.float32)
+
+    dets = []
+    for f in range(num_frames):
+        wrists += rng.normal(0, 2, wrists.shape).astype(np.float32)
+        wrists = np.clip(wrists, 0, [width, height])
+        landmarks = np.array([synthetic_hand(wx, wy, height / 10, (f // 20 + k) % 2 == 0, rng)
+                              for k, (wx, wy) in enumerate(wrists)])
+        dets.append(grabDetection.Detections(landmarks, np.array(["Left", "Right"])))
+    return dets
+
+
+# Time func on every frame. Return the time of each call in ms
+def time_calls(func, frames):
+    times = []
+    for f in frames:
+        start = time.perf_counter()
+        func(f)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+# Percentiles of the times of a stage, in ms/frame
+def percentiles(times):
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99)}
+
+
+# Time every stage on one scenario. Return the percentiles of each stage
+def run_scenario(resolution, blocks, num_frames, hands=None, dets=None):
+    # A few different frames are enough for the image stages, they are cycled through
+    images = [synthetic_frame(resolution, blocks, seed)[0] for seed in range(4)]
+    frames = [images[i % len(images)] for i in range(num_frames)]
+    _, centers = synthetic_frame(resolution, blocks, 0)
+
+    dsize = grabDetection.get_half_dimensions(frames[0])
+    halves = [cv2.resize(img, dsize) for img in images]
+    half_frames = [halves[i % len(halves)] for i in range(num_frames)]
+    rgbs = [cv2.cvtColor(cv2.flip(img, 1), cv2.COLOR_BGR2RGB) for img in half_frames]
+
+    board = contourUtil.Board(half_frames[0], side_length=SIDE_LENGTH // 2)
+    result = {}
+
+    result["resize"] = time_calls(lambda img: cv2.resize(img, grabDetection.get_half_dimensions(img)), frames)
+    result["color"] = time_calls(lambda img: cv2.cvtColor(cv2.flip(img, 1), cv2.COLOR_BGR2RGB), half_frames)
+
+    if hands is not None:
+        result["hands"] = time_calls(lambda rgb: grabDetection.detect_hands(hands, rgb), rgbs)
+
+    # The tracker runs on synthetic (or recorded) hands, on a board of its own so the grabs don't affect the others
+    tracker = grabDetection.HandTracker(contourUtil.Board(half_frames[0], side_length=SIDE_LENGTH // 2))
+    tracker.table.verbose = False
+    if dets is None:
+        dets = synthetic_detections(num_frames, dsize)
+    frame_dets = [dets[i % len(dets)] for i in range(num_frames)]
+    result["tracker"] = time_calls(lambda det: tracker.track_detections(det), frame_dets)
+
+    # Mapping every block of the frame to its cell
+    def map_blocks(_):
+        for x, y in centers:
+            board.get_center(x, y)
+    result["get_center"] = time_calls(map_blocks, half_frames)
+    result["get_centers"] = time_calls(lambda _: board.get_centers(centers), half_frames)
+
+    result["get_contours"] = time_calls(contourUtil.get_contours, half_frames)
+    result["get_contours_hough"] = time_calls(contourUtil.get_contours_hough, half_frames)
+    result["surface_level"] = time_calls(board.surface_level, half_frames)
+
+    # Incremental surface scans, with one block appearing and disappearing between frames
+    changed = halves[0].copy()
+    size = int(SIDE_LENGTH * 0.35)
+    cv2.rectangle(changed, (0, 0), (size, size), COLORS[0], -1)
+    one_block = [halves[0] if i % 2 == 0 else changed for i in range(num_frames)]
+    board = contourUtil.Board(half_frames[0], side_length=SIDE_LENGTH // 2)
+    board.surface_level(one_block[0])
+    result["surface_level_one_block"] = time_calls(board.surface_level, one_block)
+
+    overlay = grabDetection.OverlayCache()
+    result["overlay"] = time_calls(lambda img: overlay.apply(dsize, img.copy(), board), half_frames)
+
+    return {stage: percentiles(times) for stage, times in result.items()}
+
+
+# Index sets of the blocks a surface scan finds with the contours of find_contours
+def scanned_cells(board, img, find_contours):
+    cells = set()
+    for c in find_contours(img):
+        if board.sd.detect(c) not in ('rectangle', 'square'):
+            continue
+        x, y, w, h = cv2.boundingRect(c)
+        if w / board.side_length <= board.side_deviation_threshold:
+            index = board.get_center(*board.tc_to_center(x, y, w, h))
+            if index is not None:
+                cells.add(index)
+    return cells
+
+
+# Compare the blocks found by get_contours and get_contours_hough on every (step)th frame of a recording.
+# Return the number of frames compared, of blocks found by both, only by get_contours and only by get_contours_hough
+def compare_contours(video, side_length=36, step=10):
+    cap = grabDetection.open_capture(video)
+    frames = both = only_new = only_hough = 0
+    index = 0
+    while cap.isOpened():
+        success, image = cap.read()
+        if not success:
+            break
+        if index % step == 0:
+            image, _, _ = grabDetection.prepare_frame(image)
+            board = contourUtil.Board(image, side_length=side_length)
+            new = scanned_cells(board, image, contourUtil.get_contours)
+            hough = scanned_cells(board, image, contourUtil.get_contours_hough)
+            frames += 1
+            both += len(new & hough)
+            only_new += len(new - hough)
+            only_hough += len(hough - new)
+        index += 1
+    cap.release()
+    return frames, both, only_new, only_hough
+
+
+# Name of a scenario in the results
+def scenario_name(resolution, blocks):
+    return "{}x{}/{}".format(resolution[0], resolution[1], blocks)
+
+
+# Time every stage on every scenario. Return scenario name -> stage -> percentiles
+def run(resolutions, block_counts, num_frames, inference=True, landmarks=None):
+    hands = grabDetection.create_hands() if inference else None
+
+    dets = None
+    if landmarks is not None:
+        cache = landmarkCache.LandmarkCache(landmarks)
+        dets = [cache.detections(i) for i in range(len(cache))]
+
+    results = {}
+    for resolution in resolutions:
+        for blocks in block_counts:
+            # Only as many blocks as the board has cells
+            blocks = min(blocks, (resolution[0] // SIDE_LENGTH) * (resolution[1] // SIDE_LENGTH))
+            name = scenario_name(resolution, blocks)
+            if name not in results:
+                results[name] = run_scenario(resolution, blocks, num_frames, hands, dets)
+
+    if hands is not None:
+        hands.close()
+    return results
+
+
+# Compare results with a baseline. Return a list of (scenario, stage, baseline p50, p50) for every stage that is more
+# than (tolerance * 100)% and more than min_ms slower
+def compare(results, baseline, tolerance, min_ms=0.5):
+    regressions = []
+    for name, stages in results.items():
+        for stage, pct in stages.items():
+            base = baseline.get(name, {}).get(stage)
+            if base is not None and pct["p50"] > base["p50"] * (1 + tolerance) and pct["p50"] - base["p50"] > min_ms:
+                regressions.append((name, stage, base["p50"], pct["p50"]))
+    return regressions
+
+
+# Print the results as a table of ms/frame
+def report(results):
+    print("{:<18}{:<26}{:>10}{:>10}{:>10}".format("scenario", "stage", "p50 ms", "p90 ms", "p99 ms"))
+    for name, stages in results.items():
+        for stage in STAGES:
+            if stage in stages:
+                pct = stages[stage]
+                print("{:<18}{:<26}{:>10.3f}{:>10.3f}{:>10.3f}".format(name, stage, pct["p50"], pct["p90"], pct["p99"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=30, help="frames timed per scenario")
+    parser.add_argument("--resolutions", nargs="*", default=["{}x{}".format(w, h) for w, h in RESOLUTIONS],
+                        help="camera resolutions, as WIDTHxHEIGHT")
+    parser.add_argument("--blocks", nargs="*", type=int, default=BLOCK_COUNTS, help="blocks on the board")
+    parser.add_argument("--no-inference", action="store_true", help="don't time the hand detection")
+    parser.add_argument("--landmarks", default=None, help="landmark cache to time the tracker on recorded hands")
+    parser.add_argument("--out", default=None, help="save the results as JSON")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="compare the results with a baseline JSON file (by default the one in the repository)")
+    parser.add_argument("--no-baseline", dest="baseline", action="store_const", const=None,
+                        help="don't compare the results with a baseline")
+    parser.add_argument("--save-baseline", default=None, help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument("--min-ms", type=float, default=0.5, help="allowed slowdown in ms against the baseline")
+    parser.add_argument("--contours", default=None,
+                        help="compare the blocks found by get_contours and get_contours_hough on a recording, "
+                             "then exit")
+    args = parser.parse_args()
+
+    if args.contours is not None:
+        frames, both, only_new, only_hough = compare_contours(args.contours)
+        print("{} frames: {} blocks found by both, {} only by get_contours, {} only by get_contours_hough".format(
+            frames, both, only_new, only_hough))
+        sys.exit(0)
+
+    resolutions = [tuple(int(v) for v in r.split("x")) for r in args.resolutions]
+    results = run(resolutions, args.blocks, args.frames, inference=not args.no_inference, landmarks=args.landmarks)
+    report(results)
+
+    for path in (args.out, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_ms)
+        for name, stage, base, now in regressions:
+            print("Regression: {} {} {:.3f} ms -> {:.3f} ms".format(name, stage, base, now))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
@@ -0,0 +1,274 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+from videoTest import contourUtil
+from videoTest import rectification
+
+###############
+# DEFINITIONS #
+###############
+
+# calibration: what a board needs to start processing frames right away: the frame size, the block side length, the
+# grid it gives, the thresholds of the board and the corners of the board if it is rectified (see rectification.py).
+# Saved to the calibration file so the next start doesn't have to measure anything
+
+# calibration file: JSON object of camera key -> calibration. It is written to a temporary file of its own first and
+# then renamed, so a start never reads a half written file. Calibrators of one process (e.g. the stations of
+# multiCamera.py) update it one at a time, so none of them loses the calibrations the others saved
+
+# camera key: the source (camera index or video path) and the frame size, e.g. "camera:0@640x360". Another camera or
+# another resolution gets a calibration of its own
+
+# measured width: median width of the square contours of several frames, so one bad frame doesn't throw it off. Blocks
+# seen from above are squares, several blocks next to each other make rectangles, so the squares are single blocks.
+# Measured in the background on the first frames. A new calibration takes it as its side length, which the Board of
+# the next start uses (the Board of the current start already has its grid). With the default side length a block is
+# at most (side_deviation_threshold * 100)% of it, with a measured one it is about as wide as the side length, so the
+# threshold of a measured calibration is WIDTH_SLACK instead
+
+# revalidation: when a calibration was loaded from the file, the width is measured again on the first frames. If it
+# moved by more than (TOLERANCE * 100)%, the camera was probably moved or zoomed, and the file is updated for the next
+# start with the new width as side length
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# SAMPLES – frames the width is measured on
+# SAMPLE_EVERY – frames between two samples
+# TOLERANCE – change of the measured width that makes a calibration stale
+# SQUARE_RATIO – smallest ratio of the shorter to the longer side of a contour that counts as a square
+# MIN_SIDE_LENGTH – smallest measured width taken as side length, anything smaller is noise rather than a block
+# WIDTH_SLACK – largest width of a block, relative to a measured side length. Two blocks next to each other are twice
+#               as wide, so they stay out
+
+SAMPLES = 9
+SAMPLE_EVERY = 5
+TOLERANCE = 0.15
+SQUARE_RATIO = 0.8
+MIN_SIDE_LENGTH = 8
+WIDTH_SLACK = 1.25
+
+# Side length of a new calibration, the same as Board uses until the standard height is set (see contourUtil.Board)
+DEFAULT_SIDE_LENGTH = 36
+
+VERSION = 3
+
+
+# Key of a source and frame size in the calibration file
+def camera_key(source, dsize):
+    if isinstance(source, int) or str(source).isdigit():
+        name = "camera:{}".format(int(source))
+    else:
+        name = "file:{}".format(os.path.abspath(source))
+    return "{}@{}x{}".format(name, dsize[0], dsize[1])
+
+
+# Calibrations of a calibration file, as camera key -> Calibration. Missing or unreadable files give none
+def load(path):
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if data.get("version") != VERSION:
+        return {}
+    return {key: Calibration.from_dict(value) for key, value in data.get("calibrations", {}).items()}
+
+
+# Held while a calibration file is read, updated and written
+file_lock = threading.Lock()
+
+
+# Write calibrations (camera key -> Calibration) to a calibration file
+def save(path, calibrations):
+    data = {"version": VERSION, "calibrations": {key: c.to_dict() for key, c in calibrations.items()}}
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# Save one calibration to a calibration file, keeping the ones of the other cameras
+def update(path, key, calibration):
+    with file_lock:
+        calibrations = load(path)
+        calibrations[key] = calibration
+        save(path, calibrations)
+
+
+class Calibration:
+
+    def __init__(self, dsize, side_length=DEFAULT_SIDE_LENGTH, measured_width=None, side_deviation_threshold=0.8,
+                 border_ratio=6, created=None, corners=None):
+        self.dsize = tuple(dsize)
+        self.side_length = side_length
+        self.measured_width = measured_width
+        self.side_deviation_threshold = side_deviation_threshold
+        self.border_ratio = border_ratio
+        self.created = time.time() if created is None else created
+
+        # Corners of the board in the frame (see rectification.py), or None if the board isn't rectified
+        self.corners = None if corners is None else np.asarray(corners, dtype=np.float32).reshape(4, 2)
+
+    # Grid of the board, the same as contourUtil.Board builds for frames of size dsize (or for the rectified board)
+    def grid(self):
+        width, height = self.dsize if self.corners is None else rectification.board_size(self.corners)
+        return height // self.side_length + 1, width // self.side_length + 1
+
+    def to_dict(self):
+        rows, cols = self.grid()
+        return {"dsize": list(self.dsize), "side_length": self.side_length, "rows": rows, "cols": cols,
+                "measured_width": self.measured_width, "side_deviation_threshold": self.side_deviation_threshold,
+                "border_ratio": self.border_ratio, "created": self.created,
+                "corners": None if self.corners is None else self.corners.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["dsize"], d["side_length"], d.get("measured_width"), d.get("side_deviation_threshold", 0.8),
+                   d.get("border_ratio", 6), d.get("created"), d.get("corners"))
+
+    # Take a measured width as the side length (see measured width)
+    def set_side_length(self, side_length):
+        self.side_length = side_length
+        self.side_deviation_threshold = WIDTH_SLACK
+
+    # Rectifier of the board, or None if it isn't rectified
+    def rectifier(self):
+        if self.corners is None:
+            return None
+        return rectification.Rectifier(self.corners, self.dsize)
+
+    # Board set up from this calibration, without measuring anything
+    def board(self, img):
+        board = contourUtil.Board(img, side_length=self.side_length)
+        board.side_deviation_threshold = self.side_deviation_threshold
+        board.border_ratio = self.border_ratio
+        return board
+
+
+# Widths of the square contours of an image
+def square_widths(board, img):
+    cnts = contourUtil.get_contours(img, board.retrieval_mode())
+    return [w for _, (x, y, w, h) in board.sd.quadrilaterals(cnts)
+            if SQUARE_RATIO * max(w, h) <= min(w, h)]
+
+
+# Median width of the square contours of all the images, or None if none of them has one
+def measure_width(board, images):
+    widths = [w for img in images for w in square_widths(board, img)]
+    if not widths:
+        return None
+    return float(np.median(widths))
+
+
+# Side length for a measured width, or None if the width is too small to be a block
+def side_length_of(width):
+    if width is None or width < MIN_SIDE_LENGTH:
+        return None
+    return int(round(width))
+
+
+# Measures the width on the first frames of a source in the background, then saves the calibration of the source, or
+# checks that the loaded one is still valid
+class Calibrator:
+
+    # loaded: whether calibration came from the calibration file, in which case it is revalidated
+    def __init__(self, path, key, calibration, loaded, samples=SAMPLES, every=SAMPLE_EVERY):
+        self.path = path
+        self.key = key
+        self.calibration = calibration
+        self.loaded = loaded
+        self.samples = samples
+        self.every = every
+
+        self.images = []
+        self.offered = 0
+        self.thread = None
+
+        # Set when the side length was measured with the prompt, so the background measurement doesn't replace it
+        self.fixed_side_length = False
+
+        # Set when the frames offered are the camera frames, while the board and its corners are seen mirrored (like
+        # grabDetection.py shows and scans them). The kept frames are flipped, so the width is measured on the board
+        # the surface scans see
+        self.mirrored = False
+
+        # Set once the measurement is done. stale is set if the loaded calibration no longer matches the frames
+        self.done = False
+        self.stale = False
+
+    # Hand a frame to the calibrator. Only every (self.every)th frame is kept, until there are enough of them
+    def offer(self, image):
+        if self.thread is not None:
+            return
+        if self.offered % self.every == 0:
+            self.images.append(cv2.flip(image, 1) if self.mirrored else image.copy())
+        self.offered += 1
+
+        if len(self.images) >= self.samples:
+            self.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="calibration", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # The width is measured on the board as the Board sees it
+        rectifier = self.calibration.rectifier()
+        if rectifier is not None:
+            self.images = [rectifier.warp(img) for img in self.images]
+
+        board = self.calibration.board(self.images[0])
+        width = measure_width(board, self.images)
+        self.images = []
+
+        if self.loaded:
+            expected = self.calibration.measured_width
+            if width is not None and expected is not None and abs(width - expected) > TOLERANCE * expected:
+                print("Calibration of {} is stale: measured width {:.0f} instead of {:.0f}".format(
+                    self.key, width, expected))
+                self.stale = True
+            elif width is None or expected is not None:
+                # Nothing to measure, or still matching
+                self.done = True
+                return
+
+        if width is not None:
+            self.calibration.measured_width = width
+            side_length = side_length_of(width)
+            if side_length is not None and not self.fixed_side_length:
+                self.calibration.set_side_length(side_length)
+        self.calibration.created = time.time()
+
+        # Other sources may have saved their calibration since this one was loaded
+        update(self.path, self.key, self.calibration)
+        self.done = True
+
+    # Wait for the measurement to finish. If the source ran out of frames before there were enough samples, measure on
+    # the ones there are
+    def join(self, timeout=None):
+        if self.thread is None and self.images:
+            self.start()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+# Calibration of a source from the calibration file, or a new one if there is none
+# Return the calibration and its Calibrator, which measures it (or revalidates it) on the frames it is offered
+def load_calibration(path, source, dsize):
+    key = camera_key(source, dsize)
+    calibration = load(path).get(key)
+    loaded = calibration is not None
+    if not loaded:
+        calibration = Calibration(dsize)
+    return calibration, Calibrator(path, key, calibration, loaded)
@@ -1,6 +1,9 @@
+from collections import deque
+from videoTest import metrics
 from videoTest import shapeDetection
 import cv2
 import imutils
+import math
 import numpy as np
 
 ###############
@@ -13,6 +16,13 @@ import numpy as np
 # index set: the indices that the drop point has in the 2D array. Maps to point that tells Minecraft where to
 # build (pretend the building space in Minecraft is a grid)
 
+# change set: the cells of top changed by one add_single, remove_single, surface_level or build_activated, as
+# {"type": "changes", "seq": n, "cause": ..., "cells": [[p, q, old height, new height], ...]}. seq goes up by one with
+# every change set, so a consumer can tell when it missed one
+
+# snapshot: the whole of top, as {"type": "snapshot", "seq": n, "top": [[...], ...]} with the seq of the last change
+# set it includes. One is added to the change stream every self.snapshot_every change sets, so a consumer can resync
+
 #########################
 # ADJUSTABLE PARAMETERS #
 #########################
@@ -21,11 +31,16 @@ import numpy as np
 # self.side_deviation_threshold
 # self.border_ratio
 # function get_contours – every param used in the functions
+# EDGE_GAP
+# self.tile_cells, self.tile_threshold, self.full_scan_every
+# self.snapshot_every
+# HISTORY
 
 
 class Board:
 
-    def __init__(self, img):
+    # side_length: fixed calibration value. If None, it is measured from img
+    def __init__(self, img, side_length=None):
         self.side_length = 0
 
         # The side length of the contour can be up to (self.side_deviation_threshold * 100)% smaller than the side
@@ -39,50 +54,85 @@ class Board:
 
         self.sd = shapeDetection.ShapeDetector()
 
-        self.set_side_length(img)
+        # Only look at the outermost contours of the b/w image, leaving out the ones nested inside them
+        self.outer_contours_only = False
 
-        if self.side_length is None:
-            self.side_length = 36
+        # Surface scans only look again at the tiles (squares of self.tile_cells x self.tile_cells cells) whose
+        # signature changed by more than self.tile_threshold gray levels since they were last scanned, plus their
+        # neighbours. Every self.full_scan_every scans, the whole frame is scanned again to catch slow changes
+        self.incremental = True
+        self.tile_cells = 4
+        self.tile_threshold = 12
+        self.full_scan_every = 30
 
-        # TODO: Remove when standard height is set and workflow for finding side length occurs
-        self.side_length = 36
+        if side_length is not None:
+            self.side_length = side_length
+        else:
+            self.set_side_length(img)
+
+            if self.side_length is None:
+                self.side_length = 36
+
+            # TODO: Remove when standard height is set and workflow for finding side length occurs
+            self.side_length = 36
 
         self.width, self.height = img.shape[0], img.shape[1]
 
+        # Size of the grid of drop points. Rows go down the image (y) and columns go across it (x)
+        self.rows = self.width // self.side_length + 1
+        self.cols = self.height // self.side_length + 1
+
         # Creates an array with all the possible "drop points" on the board
         # Whatever is placed on the board will map to the closest center, to standardize where the blocks will map to in
         # Minecraft, which are the index set for top
-
-        self.centers = [[(self.side_length // 2 + j * self.side_length,
-                          self.side_length // 2 + i * self.side_length)
-                         for j in range(self.height // self.side_length + 1)] for i in range(self.width // self.side_length + 1)]
+        # centers[p, q] is the (x, y) of the drop point of index set (p, q)
+        half = self.side_length // 2
+        xs = half + np.arange(self.cols) * self.side_length
+        ys = half + np.arange(self.rows) * self.side_length
+        self.centers = np.stack(np.meshgrid(xs, ys), axis=-1)
 
         # Creates an array that represents a topological graph.
         # Each point represents the height (in blocks) at that point
-        self.top = [[0 for j in range(self.height // self.side_length + 1)] for i in range(self.width // self.side_length + 1)]
+        self.top = np.zeros((self.rows, self.cols), dtype=np.int32)
 
         # Array that checks if a block is there. If it is not, yet the topological array says there is, then the block
         # gets removed
 
         # Essentially a helpful heuristic in case the grab detector didn't pick up on the removed block
-        self.there = [[False for j in range(self.height // self.side_length + 1)] for l in range(self.width // self.side_length + 1)]
+        self.there = np.zeros((self.rows, self.cols), dtype=bool)
+
+        # Index sets of the cells whose height changed in the last surface scan (see surface_level)
+        self.changed = np.zeros((0, 2), dtype=np.intp)
+
+        # Downsampled gray image of the last scan of every cell (SIGNATURE_SIZE x SIGNATURE_SIZE pixels per cell), and
+        # scans since the last full scan
+        self.signature = None
+        self.partial_scans = 0
+
+        # Incremented every time top changes, so whatever is drawn from top knows when to redraw
+        self.version = 0
+
+        # Last change sets and snapshots (see changes_since), with a snapshot every self.snapshot_every change sets.
+        # self.seq is the seq of the last change set
+        self.snapshot_every = 50
+        self.stream = deque(maxlen=HISTORY)
+        self.seq = 0
+
+        # While above 0, the changes are collected into one change set by the outermost caller (see build_activated)
+        self.batching = 0
+
+        # Stage timers of the surface scans (see metrics.py). Does nothing unless replaced by a metrics.Metrics
+        self.metrics = metrics.NULL_METRICS
 
     def set_side_length(self, img):
         self.side_length = self.get_side_length(img)
 
     def get_side_length(self, img):
-        cnts = get_contours(img)
+        cnts = get_contours(img, self.retrieval_mode())
         ret = 0
 
-        for c in cnts:
-            shape = self.sd.detect(c)
-
-            # Only look at contours that are rectangles or squares because the rest probably aren't blocks
-            if not (shape == 'rectangle' or shape == 'square'):
-                continue
-
-            x, y, w, h = cv2.boundingRect(c)
-
+        # Only look at contours that are rectangles or squares because the rest probably aren't blocks
+        for c, (x, y, w, h) in self.sd.quadrilaterals(cnts):
             # The temporary strategy is to find the maximum width among all quadrilateral contours
             if w > ret:
                 ret = w
@@ -91,107 +141,232 @@ class Board:
         if ret != 0:
             return ret
 
+    # Contour retrieval mode of get_contours
+    def retrieval_mode(self):
+        return cv2.RETR_EXTERNAL if self.outer_contours_only else cv2.RETR_TREE
+
     # Convert top corner coordinate to center coordinate
     def tc_to_center(self, x, y, w, h):
         return (x + (w // 2)), (y + (h // 2))
 
     # Get the index set mapped to the closest "drop point" based on (x, y) coordinates
+    # Return None if (x, y) is outside the grid
     def get_center(self, x, y):
-        # Update the board when new blocks come up
-        for p in range(len(self.centers)):
-            for q in range(len(self.centers[0])):
-                # Determine where the block is based on which center it's closest to
-                # Center is like a "drop point" -- see doc
-                center = self.centers[p][q]
-                x_diff = abs(center[0] - x)
-                y_diff = abs(center[1] - y)
-
-                # If within half of the width of the bounding box, then it is the closest point
-                if x_diff <= self.side_length // 2 and y_diff <= self.side_length // 2:
-                    return p, q
+        # Center is like a "drop point" -- see doc. The centers are side_length apart, so the index set is found by
+        # dividing instead of checking every center. A point exactly halfway between two centers goes to the first one
+        half = self.side_length // 2
+        if x < 0 or y < 0:
+            return None
+
+        p = max(0, math.ceil((y - 2 * half) / self.side_length))
+        q = max(0, math.ceil((x - 2 * half) / self.side_length))
+        if p >= self.rows or q >= self.cols:
+            return None
+        return p, q
+
+    # Same as get_center for an array of (x, y) points, in one go
+    # Return the rows, the columns and whether each point is inside the grid. Index sets of points outside the grid are
+    # clipped to the grid, check valid before using them
+    def get_centers(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        half = self.side_length // 2
+
+        p = np.maximum(0, np.ceil((points[:, 1] - 2 * half) / self.side_length)).astype(np.intp)
+        q = np.maximum(0, np.ceil((points[:, 0] - 2 * half) / self.side_length)).astype(np.intp)
+        valid = (points[:, 0] >= 0) & (points[:, 1] >= 0) & (p < self.rows) & (q < self.cols)
+
+        return np.minimum(p, self.rows - 1), np.minimum(q, self.cols - 1), valid
 
     # Check if a block doesn't exist at a index set
     def is_block_not_at_center(self, x, y):
         # Map coordinates to a index set
-        p, q = self.get_center(x, y)
+        index = self.get_center(x, y)
+        if index is None:
+            return True
+        p, q = index
 
         # If block doesn't exist at the index set
         # 0 means no blocks at that point b/c height is zero
-        return self.top[p][q] == 0
+        return self.top[p, q] == 0
 
     # Remove single block at given coordinates
     def remove_single(self, x, y):
         # Map coordinates to a index set
-        p, q = self.get_center(x, y)
+        index = self.get_center(x, y)
+        if index is None:
+            print("Error: Removing something outside the board.")
+            return
+        p, q = index
 
         # Check if there even is a block at that index set
         if self.is_block_not_at_center(x, y):
             print("Error: Removing something that isn't there.")
         else:
-            self.top[p][q] -= 1
+            self.top[p, q] -= 1
+            self.version += 1
+            self.add_change_set("remove", [[p, q, int(self.top[p, q]) + 1, int(self.top[p, q])]])
 
     # Add a single block at given coordinates
     def add_single(self, x, y, low_layer=False):
         # Map coordinates to that index set
-        p, q = self.get_center(x, y)
+        index = self.get_center(x, y)
+        if index is None:
+            if not low_layer:
+                print("Error: Adding something outside the board.")
+            return
+        p, q = index
 
         # low_layer is a flag to see where the first layer of blocks is at (height of at least 1)
         # you don't really want to change anything if the flag is on because it's just trying to read the contours
         # the exception is that it serves as another layer of check in case grab detection doesn't detect something
         # placed at a point
         # "we know at least one thing is there" -- basically a heuristic
-        if not low_layer:
-            self.top[p][q] += 1
-        elif self.top[p][q] == 0:
-            self.top[p][q] += 1
+        if not low_layer or self.top[p, q] == 0:
+            self.top[p, q] += 1
+            self.version += 1
+            self.add_change_set("add", [[p, q, int(self.top[p, q]) - 1, int(self.top[p, q])]])
 
         # it's trying to read the contours so that we can clear out any blocks that have been mistakenly placed or not
         # detected as removed when it actually was removed
         if low_layer:
             # There was a block there, so don't remove when we check later.
-            self.there[p][q] = True
+            self.there[p, q] = True
 
     # This is the adding blocks to the top part for the lowest layer if there aren't already blocks labeled there.
     # Also checking if blocks exist at a "drop point"
-    def add_low_layer(self, img):
+    # offset: position of img in the frame, if img is a crop of it
+    # cells: mask of the index sets that may be marked as there, or None for all of them
+    def add_low_layer(self, img, offset=(0, 0), cells=None):
         # Get the contours to see where the blocks are located
-        cnts = get_contours(img)
-        for c in cnts:
-            shape = self.sd.detect(c)
-
-            if not (shape == 'rectangle' or shape == 'square'):
-                continue
-
-            x, y, w, h = cv2.boundingRect(c)
-
-            # Basically check if the contour you are looking at even remotely is close to the length of the side
-            if w / self.side_length <= self.side_deviation_threshold:
-                # Convert top corner coordinates to center
-                x, y = self.tc_to_center(x, y, w, h)
-
-                # Convert coordinates to index set
-                p, q = self.get_center(x, y)
-
-                # Check if index set is part of the border
-                if p > len(self.centers) // self.border_ratio and q > len(self.centers) // self.border_ratio:
-                    # Add single block to topology
-                    self.add_single(x, y, low_layer=True)
+        with self.metrics.stage("get_contours"):
+            cnts = get_contours(img, self.retrieval_mode())
+
+        # Only rectangles and squares, and basically check if the contour you are looking at even remotely is close to
+        # the length of the side
+        blocks = []
+        for c, (x, y, w, h) in self.sd.quadrilaterals(cnts, self.side_length, self.side_deviation_threshold):
+            # Convert top corner coordinates to center
+            blocks.append(self.tc_to_center(x + offset[0], y + offset[1], w, h))
+
+        if not blocks:
+            return
+
+        # Convert coordinates to index sets, all at once
+        ps, qs, valid = self.get_centers(blocks)
+
+        # Leave out index sets that are part of the border
+        keep = valid & (ps > self.rows // self.border_ratio) & (qs > self.rows // self.border_ratio)
+        if cells is not None:
+            keep &= cells[ps, qs]
+
+        # Same as add_single with low_layer set for every block: there was a block there, so don't remove it when we
+        # check later, and make sure the topology has at least one block there
+        self.there[ps[keep], qs[keep]] = True
+        self.fill_there()
+
+    # Downsampled gray image of img, aligned with the cells
+    def get_signature(self, img):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        gray = cv2.copyMakeBorder(gray, 0, self.rows * self.side_length - gray.shape[0], 0,
+                                  self.cols * self.side_length - gray.shape[1], cv2.BORDER_REPLICATE)
+        return cv2.resize(gray, (self.cols * SIGNATURE_SIZE, self.rows * SIGNATURE_SIZE),
+                          interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    # Find the parts of img to scan again. Return a list of (p0, q0, p1, q1) ranges of index sets, or None if the whole
+    # frame has to be scanned
+    def get_dirty_regions(self, img):
+        signature = self.get_signature(img)
+        if (not self.incremental or self.signature is None or self.signature.shape != signature.shape
+                or self.partial_scans >= self.full_scan_every):
+            self.signature = signature
+            self.partial_scans = 0
+            return None
+        self.partial_scans += 1
+
+        # Largest change of every cell since it was last scanned
+        diff = np.abs(signature - self.signature).reshape(self.rows, SIGNATURE_SIZE, self.cols, SIGNATURE_SIZE)
+        dirty = diff.max(axis=(1, 3)) > self.tile_threshold
+
+        # Group the cells into tiles, then add the neighbours of the dirty tiles
+        t = self.tile_cells
+        tiles = np.zeros((-(-self.rows // t) * t, -(-self.cols // t) * t), dtype=bool)
+        tiles[:self.rows, :self.cols] = dirty
+        tiles = tiles.reshape(tiles.shape[0] // t, t, tiles.shape[1] // t, t).any(axis=(1, 3))
+        tiles = cv2.dilate(tiles.astype(np.uint8), np.ones((3, 3), dtype=np.uint8))
+
+        # One region around every group of touching tiles
+        n, _, stats, _ = cv2.connectedComponentsWithStats(tiles, connectivity=8)
+        regions = []
+        for x, y, w, h, _ in stats[1:n]:
+            p0, q0 = y * t, x * t
+            p1, q1 = min(self.rows, (y + h) * t), min(self.cols, (x + w) * t)
+            regions.append((p0, q0, p1, q1))
+
+            # The signature of a cell only moves on when it is scanned again, so slow changes add up
+            self.signature[p0 * SIGNATURE_SIZE:p1 * SIGNATURE_SIZE, q0 * SIGNATURE_SIZE:q1 * SIGNATURE_SIZE] = \
+                signature[p0 * SIGNATURE_SIZE:p1 * SIGNATURE_SIZE, q0 * SIGNATURE_SIZE:q1 * SIGNATURE_SIZE]
+
+        self.metrics.count("surface_tiles", int(tiles.sum()))
+        return regions
+
+    # Scan the cells in [p0, p1) x [q0, q1) again, leaving the rest of there as it is
+    def scan_region(self, img, p0, q0, p1, q1):
+        self.there[p0:p1, q0:q1] = False
+        cells = np.zeros_like(self.there)
+        cells[p0:p1, q0:q1] = True
+
+        # Crop one cell beyond the region so the blocks of the cells at its edges are seen whole
+        sl = self.side_length
+        y0, x0 = max(0, (p0 - 1) * sl), max(0, (q0 - 1) * sl)
+        y1, x1 = min(img.shape[0], (p1 + 1) * sl), min(img.shape[1], (q1 + 1) * sl)
+        if y1 > y0 and x1 > x0:
+            self.add_low_layer(img[y0:y1, x0:x1], (x0, y0), cells)
 
     # Does initial block checking at the first level (make sure the val is non-zero if at least a block is there)
     # Meant to cover the "sliding" that a user can do.
     # Also helps for low level error correction if caught early on. (Someone placed a block on the low level and didn't
     # build up and our initial code didn't detect it)
     # Also accounts for the clear behavior one might do where they just slide all the blocks out of the workspace
+    # Return the index sets of the cells whose height changed, also kept in self.changed
     def surface_level(self, img):
-        # Recreate the there array because we need to scan every time, which requires a clean slate
-        self.there = [[False for j in range(self.height // self.side_length + 1)] for l in range(self.width // self.side_length + 1)]
+        with self.metrics.stage("surface_level"):
+            before = self.top.copy()
 
-        # Scan contours to get the surface (low layer implies surface because you need a low layer to begin building up
-        # and making the surface)
-        self.add_low_layer(img)
+            regions = self.get_dirty_regions(img)
+            if regions is None:
+                # Recreate the there array because we need to scan every time, which requires a clean slate
+                self.there = np.zeros((self.rows, self.cols), dtype=bool)
 
-        # Determine cleared blocks based on there
+                # Scan contours to get the surface (low layer implies surface because you need a low layer to begin
+                # building up and making the surface)
+                self.add_low_layer(img)
+            else:
+                # Only the parts of the frame that changed since the last scan. The rest of there is still valid
+                for region in regions:
+                    self.scan_region(img, *region)
+
+            # Determine cleared blocks based on there
+            self.clear_blocks()
+
+            return self.record_changes(before, "surface")
+
+    # Same as surface_level, but with a there array that was already scanned (e.g. by another process)
+    def apply_there(self, there):
+        before = self.top.copy()
+        self.there = np.array(there, dtype=bool).reshape(self.rows, self.cols)
+
+        # there no longer comes from the frames the signature was taken from
+        self.signature = None
+        self.fill_there()
         self.clear_blocks()
+        return self.record_changes(before, "surface")
+
+    # Make sure there is at least one block wherever one was found
+    def fill_there(self):
+        missing = self.there & (self.top == 0)
+        if missing.any():
+            self.top[missing] = 1
+            self.version += 1
 
     # Clear any blocks that are in the topography but not determined to be there based on the there array built through
     # scanning the contours
@@ -199,25 +374,107 @@ class Board:
         # Check if there was a block at a given index set. If so, there at that point should be true
         # and just leave it be bc it's already been processed accordingly in above
         # code. If not, then that means any block at that point has been completely removed.
-        for p in range(len(self.there)):
-            for q in range(len(self.there[0])):
-                if not self.there[p][q]:
-                    self.top[p][q] = 0
+        cleared = ~self.there & (self.top != 0)
+        if cleared.any():
+            self.top[cleared] = 0
+            self.version += 1
+
+    # Keep and return the index sets of the cells whose height is different from before, and add them to the change
+    # stream
+    def record_changes(self, before, cause):
+        self.changed = np.argwhere(self.top != before)
+        if len(self.changed):
+            ps, qs = self.changed[:, 0], self.changed[:, 1]
+            cells = np.stack([ps, qs, before[ps, qs], self.top[ps, qs]], axis=1)
+            self.add_change_set(cause, cells.tolist())
+        return self.changed
+
+    # Add a change set to the change stream, followed by a snapshot if one is due
+    def add_change_set(self, cause, cells):
+        if self.batching:
+            return
+        self.seq += 1
+        self.stream.append({"type": "changes", "seq": self.seq, "cause": cause, "cells": cells})
+        if self.seq % self.snapshot_every == 0:
+            self.stream.append(self.snapshot())
+
+    # The whole of top, for a consumer to start from or resync with
+    def snapshot(self):
+        return {"type": "snapshot", "seq": self.seq, "top": self.top.tolist()}
+
+    # Change sets and snapshots of the stream after the change set seq. If some of the change sets after it are no
+    # longer kept, only a snapshot is returned so the consumer can resync
+    def changes_since(self, seq):
+        if seq >= self.seq:
+            return []
+        first = next((r["seq"] for r in self.stream if r["type"] == "changes"), None)
+        if first is None or first > seq + 1:
+            return [self.snapshot()]
+        return [r for r in self.stream if r["seq"] > seq]
 
     # Function to use if user decides when to build
     def build_activated(self, log, img):
-        # Checks the log file as to where and what operations needs to be done (grab block, release block)
-        for x, y, release in log:
-            if release:
-                self.remove_single(x, y)
-            else:
-                self.add_single(x, y)
+        before = self.top.copy()
+        self.batching += 1
+        try:
+            # Checks the log file as to where and what operations needs to be done (grab block, release block)
+            for x, y, release in log:
+                if release:
+                    self.remove_single(x, y)
+                else:
+                    self.add_single(x, y)
+
+            # heuristic to check for faulty or missed operations
+            self.surface_level(img)
+        finally:
+            self.batching -= 1
+
+        # All of it as one change set
+        return self.record_changes(before, "build")
+
+
+# mode: contour retrieval mode of cv2.findContours, cv2.RETR_EXTERNAL to only get the outermost contours
+def get_contours(img, mode=cv2.RETR_TREE):
+    # Process the image to be a sharp black and white contrast to find contours
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
+
+    thresh = cv2.threshold(blurred, 150, 255, cv2.THRESH_BINARY)[1]
+
+    # Cut the b/w image along the edges to separate blocks that touch
+    thresh[edge_mask(gray) > 0] = 0
 
-        # heuristic to check for faulty or missed operations
-        self.surface_level(img)
+    # Get the contours
+    cnts = cv2.findContours(thresh, mode, cv2.CHAIN_APPROX_SIMPLE)
+    cnts = imutils.grab_contours(cnts)
+
+    return cnts
+
+
+# Change sets and snapshots kept by a board for consumers that fall behind (see Board.changes_since)
+HISTORY = 256
 
+# Pixels per cell side in the signature of a surface scan
+SIGNATURE_SIZE = 4
 
-def get_contours(img):
+# Kernels that close gaps of up to EDGE_GAP - 1 pixels along horizontal and vertical edges
+EDGE_GAP = 5
+EDGE_KERNELS = [cv2.getStructuringElement(cv2.MORPH_RECT, (EDGE_GAP, 1)),
+                cv2.getStructuringElement(cv2.MORPH_RECT, (1, EDGE_GAP))]
+
+
+# Get the edges via Canny edge detection, with small gaps along the sides of the blocks closed. Same purpose as the
+# lines drawn by get_contours_hough, at a fixed cost per pixel
+def edge_mask(gray):
+    edges = cv2.Canny(gray, 100, 200, apertureSize=3)
+    mask = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, EDGE_KERNELS[0])
+    cv2.bitwise_or(mask, cv2.morphologyEx(edges, cv2.MORPH_CLOSE, EDGE_KERNELS[1]), mask)
+    return mask
+
+
+# Previous version of get_contours, which draws every line segment found by HoughLinesP onto the b/w image.
+# Kept to compare speed and accuracy with (see benchmark.py)
+def get_contours_hough(img):
     # Process the image to be a sharp black and white contrast to find contours
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
@@ -243,4 +500,3 @@ def get_contours(img):
     cnts = imutils.grab_contours(cnts)
 
     return cnts
-
@@ -0,0 +1,207 @@
+import queue
+import threading
+
+###############
+# DEFINITIONS #
+###############
+
+# stage: one step of the frame loop (hand inference, tracking, ...) that runs on its own thread and reads its input
+# from a bounded queue
+
+# drop stale: policy for live sources (webcams). When a stage falls behind, the oldest frame waiting in its queue is
+# thrown away so the pipeline always works on the most recent frame
+
+# never drop: policy for recorded sources (video files). When a stage falls behind, the stage before it blocks until
+# there is room, so every frame of the video gets processed
+
+# failure: an exception in a stage (or in reading the source) stops the whole pipeline, and Pipeline.run raises it
+# again once every thread has finished
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# self.maxsize – how many frames can wait in front of each stage
+
+# Marker sent down the pipeline once the source runs out of frames
+END = object()
+
+# How long a blocked queue operation waits before checking if the pipeline was stopped
+POLL_INTERVAL = 0.1
+
+
+class Stage:
+
+    def __init__(self, name, func, maxsize, drop_stale, stop_event):
+        self.name = name
+
+        # Function applied to every frame. Returning None drops the frame from the rest of the pipeline
+        self.func = func
+
+        # Frames waiting to be processed by this stage
+        self.queue = queue.Queue(maxsize)
+
+        self.drop_stale = drop_stale
+        self.stop_event = stop_event
+
+        # Stage that receives the output of this one. The last stage has no next stage
+        self.next = None
+
+        self.thread = None
+
+        # Counters for reporting
+        self.processed = 0
+        self.dropped = 0
+
+        # Exception that stopped the stage, if any
+        self.error = None
+
+    # Number of frames waiting in front of this stage
+    def depth(self):
+        return self.queue.qsize()
+
+    # Hand a frame to this stage, following the drop policy of the pipeline
+    # Return False if the pipeline was stopped before the frame could be queued
+    def put(self, item):
+        # The end marker is never dropped, otherwise the stages after this one would never finish
+        if self.drop_stale and item is not END:
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put_nowait(item)
+                    return True
+                except queue.Full:
+                    # Throw away the oldest frame to make room for the newest one
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+            return False
+
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Take the next frame out of the queue. Return None if the pipeline was stopped
+    def get(self):
+        while not self.stop_event.is_set():
+            try:
+                return self.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return None
+
+    # Process one frame and pass the result to the next stage
+    # Return False once the stage is done (end of the source or pipeline stopped)
+    def step(self):
+        item = self.get()
+        if item is None:
+            return False
+
+        if item is END:
+            if self.next is not None:
+                self.next.put(END)
+            return False
+
+        out = self.func(item)
+        self.processed += 1
+
+        if out is not None and self.next is not None:
+            return self.next.put(out)
+        return True
+
+    # Worker loop of the stage. An exception stops the pipeline instead of leaving the other stages waiting
+    def run(self):
+        try:
+            while self.step():
+                pass
+        except Exception as e:
+            self.error = e
+            self.stop_event.set()
+
+
+class Pipeline:
+
+    # read: function returning the next frame of the source, or None when the source is exhausted
+    # stages: list of (name, func) in the order the frames flow through them
+    def __init__(self, read, stages, drop_stale=False, maxsize=4):
+        self.read = read
+        self.drop_stale = drop_stale
+        self.maxsize = maxsize
+
+        # Set when the pipeline has to shut down before the source is exhausted
+        self.stop_event = threading.Event()
+
+        self.stages = [Stage(name, func, maxsize, drop_stale, self.stop_event) for name, func in stages]
+        for prev, nxt in zip(self.stages, self.stages[1:]):
+            prev.next = nxt
+
+        self.capture_thread = None
+
+        # Number of frames read from the source
+        self.captured = 0
+
+        # Exception raised by read, if any
+        self.error = None
+
+    # Queue depth of each stage, in pipeline order
+    def depths(self):
+        return [(s.name, s.depth()) for s in self.stages]
+
+    # Number of frames dropped by each stage, in pipeline order
+    def drops(self):
+        return [(s.name, s.dropped) for s in self.stages]
+
+    # Worker loop of the capture stage
+    def capture(self):
+        first = self.stages[0]
+        try:
+            while not self.stop_event.is_set():
+                frame = self.read()
+                if frame is None:
+                    break
+                self.captured += 1
+                if not first.put(frame):
+                    break
+        except Exception as e:
+            self.error = e
+            self.stop_event.set()
+            return
+        first.put(END)
+
+    # Start the capture stage and every stage but the last one on their own threads.
+    # The last stage is driven by run() so that it can stay on the calling thread (cv2.imshow has to run on the main
+    # thread on some platforms)
+    def start(self):
+        self.capture_thread = threading.Thread(target=self.capture, name="capture", daemon=True)
+        self.capture_thread.start()
+
+        for s in self.stages[:-1]:
+            s.thread = threading.Thread(target=s.run, name=s.name, daemon=True)
+            s.thread.start()
+
+    # Run the last stage on the calling thread until the source is exhausted or stop() is called
+    # Raise the first exception of the capture or of a stage once all the threads have finished
+    def run(self):
+        self.start()
+        try:
+            self.stages[-1].run()
+        finally:
+            self.stop()
+
+        for error in [self.error] + [s.error for s in self.stages]:
+            if error is not None:
+                raise error
+
+    # Stop all the stages and wait for their threads to finish
+    def stop(self):
+        self.stop_event.set()
+        if self.capture_thread is not None:
+            self.capture_thread.join()
+        for s in self.stages[:-1]:
+            if s.thread is not None:
+                s.thread.join()
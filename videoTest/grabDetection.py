@@ -1,8 +1,15 @@
+import argparse
 import cv2
+import json
 import mediapipe as mp
-import math
-from copy import deepcopy
+import numpy as np
+import time
+from videoTest import assignment
+from videoTest import calibration
 from videoTest import contourUtil
+from videoTest import framePipeline
+from videoTest import metrics
+from videoTest import rectification
 mp_drawing = mp.solutions.drawing_utils
 mp_hands = mp.solutions.hands
 
@@ -10,56 +17,74 @@ mp_hands = mp.solutions.hands
 # ADJUSTABLE PARAMETERS #
 #########################
 
-# self.grace_period_timer
-# self.grace_period_timer_threshold
-# self.grace_period_reset_toggle
-# self.stability_timer
-# self.stability_timer_threshold
-# self.distance_params
-# self.grabbing_params
-# variable trigger – line 461
+# HandTrackTable.grace_period_timer_threshold
+# HandTrackTable.stability_timer_threshold
+# HandTrackTable.distance_params
+# HandTrackTable.grabbing_params
+# HandTracker.trigger
 
-# Get euclidean distance of two points
-def eud_dist(a_x, a_y, b_x, b_y):
-    dist = ((a_x - b_x) ** 2) + ((a_y - b_y) ** 2)
-    return math.sqrt(dist)
-
-
-# Get midpoint of two points
-def find_midpoint(a_x, a_y, b_x, b_y):
-    return ((a_x + b_x) / 2, (a_y + b_y) / 2)
+# Index of the wrist and of every fingertip in the hand landmarks. Finger f (0 = wrist, 1 = thumb, 2 = index finger, ...)
+# is at landmark f * 4
+FINGERTIPS = [0, 4, 8, 12, 16, 20]
 
 
 # Convert normalized hand coordiates to image coordinates
+# Return a (number of hands, 21, 2) float32 array
 def hlist_to_coords(hlist, dsize):
-    ret = []
-    for hl in hlist:
-        temp1 = []
-        for val in hl.landmark._values:
-            temp = [val.x * dsize[0], val.y * dsize[1]]
-            temp1.append(temp)
-        ret.append(temp1)
+    ret = np.array([[(val.x, val.y) for val in hl.landmark] for hl in hlist], dtype=np.float32).reshape(-1, 21, 2)
+    ret *= np.array(dsize, dtype=np.float32)
     return ret
 
 
-# Get the distance between two fingertips
-def finger_to_finger_dist(hl, f1, f2):
-    i1 = f1 * 4
-    i2 = f2 * 4
-    point1 = hl[i1]
-    point2 = hl[i2]
-    distance = eud_dist(point1[0], point1[1], point2[0], point2[1])
-    return distance
+# Get the label ("Left" or "Right") of every hand, in the same order as the landmarks
+def handedness_labels(multi_handedness):
+    return np.array([h.classification[0].label for h in multi_handedness])
+
+
+# Check if the thumb is open by comparing the tip and the joint before the tip with the joint two before the tip
+# Return one bool per hand
+def thumb_open(landmarks):
+    pseudo_fix_key_point = landmarks[:, 2, 0]
+    return (landmarks[:, 3, 0] < pseudo_fix_key_point) & (landmarks[:, 4, 0] < pseudo_fix_key_point)
+
 
+# Get the distance between every pair of fingertips (finger numbering of FINGERTIPS)
+# Return a (number of hands, 6, 6) array
+def finger_distances(landmarks):
+    tips = landmarks[:, FINGERTIPS]
+    return np.linalg.norm(tips[:, :, None] - tips[:, None], axis=-1)
+
+
+# Get the distance between every location in locs and the wrist of every hand
+# Return a (len(locs), number of hands) array
+def wrist_displacement(locs, landmarks):
+    locs = np.asarray(locs, dtype=np.float32).reshape(-1, 2)
+    return np.linalg.norm(locs[:, None] - landmarks[None, :, 0], axis=-1)
+
+
+# The hands found in a frame, with the geometry of every hand computed at once
+class Detections:
+    # landmarks: (number of hands, 21, 2) array in image coordinates
+    # handedness: label of every hand
+    def __init__(self, landmarks, handedness):
+        self.landmarks = landmarks
+        self.handedness = handedness
 
-# Check if thumb is near finger based on a upper and lower bound
-def is_thumb_near_finger(hl, finger, lb, ub):
-    return is_finger_near_finger(hl, 1, finger, lb, ub)
+        self.thumb_open = thumb_open(self.landmarks)
+        self.finger_distances = finger_distances(self.landmarks)
 
+        # Hands that haven't been matched to a tracked hand yet
+        self.available = np.ones(len(self.landmarks), dtype=bool)
 
-# Check if finger is near finger based on a upper and lower bound
-def is_finger_near_finger(hl, f1, f2, lb, ub):
-    return lb < finger_to_finger_dist(hl, f1, f2) < ub
+    def __len__(self):
+        return len(self.landmarks)
+
+    # Get the hands found by the hand detection, in image coordinates
+    @classmethod
+    def from_results(cls, results, dsize):
+        if results.multi_handedness is None:
+            return cls(np.zeros((0, 21, 2), dtype=np.float32), np.zeros(0, dtype="<U5"))
+        return cls(hlist_to_coords(results.multi_hand_landmarks, dsize), handedness_labels(results.multi_handedness))
 
 
 # Get the half dimensions of a image
@@ -100,7 +125,55 @@ def drawlines(dim, img, b):
     return img
 
 
+# Draw the grid lines and the marks on where blocks are located
+def draw_board(dim, img, b):
+    # Draw grid lines to the image
+    img = drawlines(dim, img, b)
+
+    # Draw marks on where blocks are located at all times
+    for cx, cy in b.centers[b.top != 0]:
+        img = cv2.circle(img, (int(cx), int(cy)), 30, (0, 255, 0), 10)
+
+    return img
+
+
+# The grid and the block marks drawn once into an overlay, and only drawn again when the board changes
+class OverlayCache:
+    # rectifier: if the board is rectified (see rectification.py), the overlay is drawn on the rectified board and put
+    # back into frame coordinates
+    def __init__(self, rectifier=None):
+        self.rectifier = rectifier
+
+        # What the overlay was drawn for: board version, side length and frame size
+        self.key = None
+
+        self.overlay = None
+
+        # Pixels of the overlay that were drawn on
+        self.mask = None
+
+    # Draw the overlay again if the board changed since the last time
+    def refresh(self, dim, b):
+        key = (b.version, b.side_length, tuple(dim))
+        if key == self.key:
+            return
+
+        if self.rectifier is None:
+            overlay = draw_board(dim, np.zeros((dim[1], dim[0], 3), dtype=np.uint8), b)
+        else:
+            overlay = self.rectifier.unwarp(draw_board(self.rectifier.size, self.rectifier.blank(), b))
+        self.mask = overlay.any(axis=2).astype(np.uint8)
+        self.overlay = overlay
+        self.key = key
+
+    # Copy the overlay onto the frame, in place
+    def apply(self, dim, img, b):
+        self.refresh(dim, b)
+        return cv2.copyTo(self.overlay, self.mask, img)
+
+
 # Get the measurement of the blocks
+# Return the measured width (see calibration.py), or None if no block was found
 def prompt_measurement(cap, img):
     txt = 'Put Block Down For Measurement. Press "a" when complete.'
     img_txt = cv2.putText(img, txt, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 0, 0), 2, cv2.LINE_AA)
@@ -114,7 +187,7 @@ def prompt_measurement(cap, img):
 
     # resize image
     img = cv2.resize(img, ds)
-    board_ret = contourUtil.Board(img)
+    width = calibration.measure_width(contourUtil.Board(img), [img])
 
     txt = 'Remove block. Press "a" when complete.'
     img_txt = cv2.putText(img, txt, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 0, 0), 2, cv2.LINE_AA)
@@ -122,348 +195,990 @@ def prompt_measurement(cap, img):
     cv2.imshow('MediaPipe Hands', img_txt)
     if cv2.waitKey(0) == ord('a'):
         pass
-    return board_ret
-
-
-class hand:
-    def __init__(self, mhl_val, handedness, curr_board, grabbing=False):
-        # Last location of the hand (based on wrist)
-        self.last_loc = mhl_val[0]
+    return width
 
-        # State of whether the hand is moving
-        self.moving = False
-
-        # State of whether the hand is grabbing something
-        self.grabbing = grabbing
-
-        # Whether it's the left or right hand
-        self.handedness = handedness
-
-        # Keep track of the time since a hand appeared
-        # The code won't start detecting if the hand is grabbing anything until the grace period is past the
-        # maximum grace period set (self.max_gp)
-        self.grace_period_timer = 0
 
+# All the tracked hands, stored as one array per attribute (one row per hand) so that the state of every hand is
+# updated at once
+class HandTrackTable:
+    def __init__(self, side_length, capacity=4):
+        # The code won't start detecting if the hand is grabbing anything until the grace period timer of the hand is
+        # past this threshold
         self.grace_period_timer_threshold = 1
 
         # Avoid instant fluctuations
         # The heuristic is that we are assuming the hand can't actually re-drop or re-grab anything in 6 frames (0.1 of
         # a second), so we want to have the hand stabilize first before determining a drop or grab
-
-        # Similar role to the grace period, but different functionality
-        self.stability_timer = 0
-
         # The threshold where we can conclude that the hand is stablized
         self.stability_timer_threshold = 5
 
         # The lower and upper bound to what distance a hand travels still qualifies it being the same hand we were
         # already tracking
         # Arbitrary values, need to mess around with
-        self.distance_params = [curr_board.side_length / 4, curr_board.side_length]
+        self.distance_params = [side_length / 4, side_length]
 
         # The lower and upper bound to what distance the fingers need to be at to qualify for the fingers to be close
         # enough (grabbing something)
         # Trying to do sqrt(2) more than side length in the case of holding it by the diagonal
-        self.grabbing_params = [0, curr_board.side_length * 1.35]
+        self.grabbing_params = [0, side_length * 1.35]
 
-    # String representation of a hand, for debugging purposes
-    def __str__(self):
-        return str(self.last_loc[0]) + " " + str(self.last_loc[1]) + " " + str(self.handedness) \
-               + " " + str(self.grabbing)
+        # Order in which the hands started being tracked. Hands are always processed in that order
+        self.next_order = 0
 
-    # Debug representation of a hand, for debugging purposes
-    def __repr__(self):
-        return str(self.last_loc[0]) + " " + str(self.last_loc[1]) + " " + str(self.handedness) \
-               + " " + str(self.grabbing)
-
-    # Check if the hand is not moving
-    def is_still(self, loc):
-        # Get the distance from the current location and the last location
-        distance = eud_dist(loc[0], loc[1], self.last_loc[0], self.last_loc[1])
-        params = self.distance_params
-        # The distance should be less than the moving lower bounds to qualify as not moving
-        return distance < params[0]
+        # Print every grab and release
+        self.verbose = True
 
-    # Check if the hand is moving
-    def is_moving(self, loc):
-        # Get the distance from the current location and the last location
-        distance = eud_dist(loc[0], loc[1], self.last_loc[0], self.last_loc[1])
-        params = self.distance_params
-        # The distance should be within the moving bounds to qualify as moving
-        return params[0] < distance < params[1]
-
-    # Return new location and index if there, else return None
-    def find_loc(self, mh, mhl):
-        for i in range(0, len(mh)):
-            # Get the information about the current hand
-            handedness = mh[i].classification._values[0].label
-
-            # Get the coordinates of the points of the hand
-            mhl_val = mhl[i]
-
-            # Get the wrist coordinates
-            loc = mhl_val[0]
-
-            # Check if the hand is moving. If not, then no need to update the information
-            if self.is_moving(loc) or self.is_still(loc):
-                # Update everything else and return the location of the hand and the index
-                self.handedness = handedness
-                return loc, i
-        # Otherwise, if hand is not found, return None
-        return None, None
-
-    # Update the last location of the hand
-    # Return True if successful, else False
-    def update_loc(self, mh, mhl):
-        # Get the location of the hand
-        loc, ind = self.find_loc(mh, mhl)
-
-        # Update it if the location was found
-        if loc is not None:
-            self.last_loc = loc
-            return True
-        return False
+        self.allocate(capacity)
 
-    # Check to see if the hand is grabbing something
-    # Return True if grabbing, else False
-    def is_grabbing(self, mh, mhl):
-        # If it's moving, just return whatever the old value was. We are assuming we can't throw items and we can't
-        # pick items up that quickly
-        if self.moving:
-            return self.grabbing
+    # Create empty arrays for (capacity) hands
+    def allocate(self, capacity):
+        # Whether the row holds a hand that is being tracked
+        self.active = np.zeros(capacity, dtype=bool)
 
-        # Get location and index of the hand
-        loc, ind = self.find_loc(mh, mhl)
+        # Order in which the hand started being tracked
+        self.order = np.zeros(capacity, dtype=np.int64)
 
-        # If hand is not found, then it's not moving
-        if loc is None:
-            return False
+        # Last location of the hand (based on wrist)
+        self.last_loc = np.zeros((capacity, 2), dtype=np.float32)
 
-        # Get the coordinates of the points on the hand
-        hand_landmarks = mhl[ind]
+        # State of whether the hand is moving
+        self.moving = np.zeros(capacity, dtype=bool)
 
-        # Check if the thumb is open by comparing the tip and the joint before the tip with the joint two before the tip
-        pseudoFixKeyPoint = hand_landmarks[2][0]
-        thumbIsOpen = hand_landmarks[3][0] < pseudoFixKeyPoint and hand_landmarks[4][0] < pseudoFixKeyPoint
+        # State of whether the hand is grabbing something
+        self.grabbing = np.zeros(capacity, dtype=bool)
 
-        p = self.grabbing_params
+        # Whether it's the left or right hand
+        self.handedness = np.zeros(capacity, dtype="<U5")
+
+        # Keep track of the time since a hand appeared
+        self.grace_period_timer = np.zeros(capacity, dtype=np.int64)
+
+        # Similar role to the grace period, but different functionality
+        self.stability_timer = np.zeros(capacity, dtype=np.int64)
+
+    # Double the number of hands the table can hold, keeping the tracked ones
+    def grow(self):
+        old = (self.active, self.order, self.last_loc, self.moving, self.grabbing, self.handedness,
+               self.grace_period_timer, self.stability_timer)
+        self.allocate(len(self.active) * 2)
+        new = (self.active, self.order, self.last_loc, self.moving, self.grabbing, self.handedness,
+               self.grace_period_timer, self.stability_timer)
+        for o, n in zip(old, new):
+            n[:len(o)] = o
+
+    def __len__(self):
+        return int(self.active.sum())
+
+    # String representation of the tracked hands, for debugging purposes
+    def __repr__(self):
+        return "\n".join("{} {} {} {}".format(self.last_loc[i, 0], self.last_loc[i, 1], self.handedness[i],
+                                              self.grabbing[i]) for i in self.rows())
+
+    # Rows of the tracked hands, in the order they started being tracked
+    def rows(self):
+        rows = np.flatnonzero(self.active)
+        return rows[np.argsort(self.order[rows], kind="stable")]
+
+    # Stop tracking every hand
+    def clear(self):
+        self.active[:] = False
+
+    # Check if the hand is not moving, for each of the distances travelled
+    def is_still(self, distance):
+        # The distance should be less than the moving lower bounds to qualify as not moving
+        return distance < self.distance_params[0]
+
+    # Check if the hand is moving, for each of the distances travelled
+    def is_moving(self, distance):
+        # The distance should be within the moving bounds to qualify as moving
+        return (self.distance_params[0] < distance) & (distance < self.distance_params[1])
+
+    # Start tracking the given detections as new hands (might be mistakenly considered new)
+    def add(self, det, indices):
+        for i in indices:
+            free = np.flatnonzero(~self.active)
+            if len(free) == 0:
+                self.grow()
+                free = np.flatnonzero(~self.active)
+            r = free[0]
+
+            self.active[r] = True
+            self.order[r] = self.next_order
+            self.next_order += 1
+            self.last_loc[r] = det.landmarks[i, 0]
+            self.moving[r] = False
+            self.grabbing[r] = False
+            self.handedness[r] = det.handedness[i]
+            self.grace_period_timer[r] = 0
+            self.stability_timer[r] = 0
+
+    # Match the tracked hands to the detections of the frame, all at once. Distances outside of distance_params are not
+    # allowed, and among the remaining ones the total distance travelled by the hands is minimized.
+    # Return the rows of the tracked hands and the detection matched to each of them (-1 if the hand wasn't found), and
+    # mark the matched detections as taken
+    def associate(self, det):
+        rows = self.rows()
+        matches = np.full(len(rows), -1)
+        if len(rows) == 0 or len(det) == 0:
+            return rows, matches
+
+        # Distance between the last location of every tracked hand and the wrist of every detection
+        distance = wrist_displacement(self.last_loc[rows], det.landmarks)
+        gate = self.is_moving(distance) | self.is_still(distance)
+
+        # Pairs that are not allowed get a cost higher than any set of allowed pairs, so the solution first matches as
+        # many hands as possible
+        cost = np.where(gate, distance, distance[gate].sum() + 1)
+        r, c = assignment.linear_assignment(cost)
+
+        keep = gate[r, c]
+        matches[r[keep]] = c[keep]
+        det.available[c[keep]] = False
+        return rows, matches
+
+    # Update every tracked hand with the detections of a frame.
+    # Return the list of (x, y, release) for every hand that toggled its grab state, in tracking order
+    def update(self, det):
+        rows, matches = self.associate(det)
+
+        # Hands that weren't found are no longer tracked
+        self.active[rows[matches < 0]] = False
+        found = matches >= 0
+        rows, matches = rows[found], matches[found]
+
+        self.handedness[rows] = det.handedness[matches]
 
         # Check if the fingers are near the thumb. If so, then the given finger is doing a pinching motion with the
         # thumb
-        p2 = is_thumb_near_finger(hand_landmarks, 2, p[0], p[1])
-
         # Focus on only index finger for now
-        pincher = p2
-        grab = not thumbIsOpen and pincher
-
-        return grab
-
-    # If the grab state has changed, update it and reset the timer for stability delay
-    def update_grabbing(self, mh, mhl):
-        new_grab = self.is_grabbing(mh, mhl)
-        if self.grabbing != new_grab:
-            self.stability_timer = 0
-        self.grabbing = new_grab
-
-    # Check if toggled from grabbing to not, and vice versa. Find loc, convert it to pic coordinates, and print it,
-    # with the change. Return coordinates.
-    def print_toggle(self, mh, mhl, img):
-        # If grace period timer less than threshold, still in grace period, so don't check
-        if self.grace_period_timer <= self.grace_period_timer_threshold:
-            return None, None, None
-
-        # Get location and index of hand
-        loc, ind = self.find_loc(mh, mhl)
-        # If hand is not found, don't return coordinates
-        if loc is not None:
-            # Get location of potential drop
-            thumb = mhl[ind][4]
-            index = mhl[ind][8]
-            mid = find_midpoint(thumb[0], thumb[1], index[0], index[1])
-            x = mid[0]
-            y = mid[1]
-
-            # Check if the hand is stable and has toggled grab state
-            grabbing = self.is_grabbing(mh, mhl)
-            if grabbing and not self.grabbing and self.stability_timer >= self.stability_timer_threshold:
+        p = self.grabbing_params
+        pinch = det.finger_distances[matches, 1, 2]
+        pincher = (p[0] < pinch) & (pinch < p[1])
+        pinching = ~det.thumb_open[matches] & pincher
+
+        # If it's moving, just keep whatever the old value was. We are assuming we can't throw items and we can't pick
+        # items up that quickly
+        grabbing = np.where(self.moving[rows], self.grabbing[rows], pinching)
+
+        # Check if toggled from grabbing to not, and vice versa, once the grace period is over and the hand is stable
+        ready = (self.grace_period_timer[rows] > self.grace_period_timer_threshold) & \
+                (self.stability_timer[rows] >= self.stability_timer_threshold)
+        grabbed = ready & grabbing & ~self.grabbing[rows]
+        released = ready & self.grabbing[rows] & ~grabbing
+
+        # Location of the potential drop, between the thumb and the index finger
+        mid = (det.landmarks[matches, 4] + det.landmarks[matches, 8]) / 2
+
+        lod = []
+        for i in np.flatnonzero(grabbed | released):
+            x, y = float(mid[i, 0]), float(mid[i, 1])
+            if not self.verbose:
+                pass
+            elif grabbed[i]:
                 print("Grabbed at ({}, {})".format(x, y))
-                return x, y, True
-            if self.grabbing and not grabbing and self.stability_timer >= self.stability_timer_threshold:
+            else:
                 print("Released at ({}, {})".format(x, y))
-                return x, y, False
-        return None, None, None
+            lod.append((x, y, bool(grabbed[i])))
 
-    # Return index. Check if there first, then update grabbing, then update loc.
-    # It'll be on the main function to take index and remove available entry or remove hand.
-    def update_everything(self, mh, mhl):
-        loc, ind = self.find_loc(mh, mhl)
-        if loc is None:
-            return None
+        # Update all the information about the hands from the last time to this frame
+        wrists = det.landmarks[matches, 0]
+        self.moving[rows] = self.is_moving(np.linalg.norm(wrists - self.last_loc[rows], axis=1))
 
-        self.moving = self.is_moving(loc)
-        self.update_grabbing(mh, mhl)
-        self.update_loc(mh, mhl)
+        # If the grab state has changed, update it and reset the timer for stability delay
+        new_grab = np.where(self.moving[rows], self.grabbing[rows], pinching)
+        self.stability_timer[rows[new_grab != self.grabbing[rows]]] = 0
+        self.grabbing[rows] = new_grab
+
+        self.last_loc[rows] = wrists
 
         # Update the times as well
-        self.grace_period_timer += 1
-        self.stability_timer += 1
-        return ind
+        self.grace_period_timer[rows] += 1
+        self.stability_timer[rows] += 1
+
+        return lod
+
+
+# Keeps track of the hands between frames and applies the grabs and releases they make to the board
+class HandTracker:
+    # rectifier: if the board is rectified (see rectification.py), the grabs and releases are mapped to board
+    # coordinates and the surface scans look at the rectified board
+    def __init__(self, board, trigger=10, rectifier=None):
+        # Board for Minecraft conversion
+        self.board = board
+        self.rectifier = rectifier
 
+        # Tracked hands
+        self.table = HandTrackTable(board.side_length)
 
-def main():
+        # Whether a frame has no hands in it
+        self.no_hands = None
+
+        # Trigger board cleanup when there are no hands for (trigger) consecutive frames
+        self.trigger = trigger
+
+        # Log of all the actions taken
+        self.log = []
+
+        # Whether the scene moved since the last time the board surface was scanned
+        self.surface_stale = True
+
+    # Match the hands found in a frame against the tracked hands and update the board with any grab or release.
+    # Return the list of (x, y, release) where blocks have been grabbed or dropped in this frame
+    def update(self, results, dsize, image):
+        # Get the hand info
+        return self.update_detections(Detections.from_results(results, dsize))
+
+    # Same as update, with the hands of the frame already converted to image coordinates
+    def update_detections(self, det):
+        # If there is no hand info then there are no hands in the frame
+        if len(det) == 0:
+            # No hands are detected so remove all the currently tracked hands and update the no_hands state
+            # No hands state only begins keeping track after hands initially appear
+            self.table.clear()
+            if self.no_hands is not None:
+                self.no_hands += 1
+            return []
+
+        # See if any grab or drop occurred
+        lod = self.table.update(det)
+
+        # If a grab or drop occurred, update the board
+        for x, y, release in self.board_coordinates(lod):
+            if release:
+                self.board.remove_single(x, y)
+            else:
+                self.board.add_single(x, y)
+
+            # Log used to keep track of what was dropped and picked up
+            self.log.append([x, y, release])
+
+        # Add whatever remaining hands that didn't match any of the tracked hands to the tracked hands
+        self.table.add(det, np.flatnonzero(det.available))
+        self.no_hands = 0
+
+        return lod
+
+    # Grabs and drops in the coordinates of the board
+    def board_coordinates(self, lod):
+        if self.rectifier is None or not lod:
+            return lod
+        points = self.rectifier.to_board([(x, y) for x, y, _ in lod])
+        return [(float(x), float(y), release) for (x, y), (_, _, release) in zip(points, lod)]
+
+    # Check if the no_hands state has started keeping track and is triggered
+    # If triggered, reset the no hands state so the caller can clean up the surface
+    def surface_due(self):
+        if self.no_hands is not None and self.no_hands > self.trigger:
+            self.no_hands = 0
+            return True
+        return False
+
+    # Called instead of update for frames where the scene didn't move. The hands keep their state, but if they left the
+    # board and it hasn't been scanned since, it is still scanned once
+    def idle(self):
+        return self.no_hands is not None and self.no_hands > 0 and self.surface_stale
+
+    # Update the tracker with a frame. If the scene didn't move, the hands are left as they are.
+    # Return the grabs and drops of the frame and whether the board surface should be scanned
+    def track(self, results, dsize, image, moving=True):
+        if not moving:
+            return [], self.idle()
+        return self.track_detections(Detections.from_results(results, dsize))
+
+    # Same as track for a frame that moved, with the hands of the frame already converted to image coordinates
+    def track_detections(self, det):
+        self.surface_stale = True
+        lod = self.update_detections(det)
+        return lod, self.surface_due()
+
+    # Clean up the board from the blocks actually seen on its surface
+    def scan_surface(self, image):
+        if self.rectifier is not None:
+            image = self.rectifier.warp(image)
+        self.board.surface_level(image)
+        self.surface_stale = False
+
+
+# Check if the video source is a webcam (device index) rather than a file
+def is_webcam(source):
+    return isinstance(source, int) or str(source).isdigit()
+
+
+# Open a video source, accepting webcam indices given as strings
+def open_capture(source):
+    if is_webcam(source):
+        source = int(source)
+    return cv2.VideoCapture(source)
+
+
+# Resize the frame and make the mirrored RGB copy that MediaPipe expects.
+# Return the resized frame, the RGB copy and the size of both
+def prepare_frame(image):
+    # Resize image
+    dsize = get_half_dimensions(image)
+    image = cv2.resize(image, dsize)
+
+    # Flip the image horizontally for a later selfie-view display, and convert
+    # the BGR image to RGB.
+    rgb = cv2.cvtColor(cv2.flip(image, 1), cv2.COLOR_BGR2RGB)
+    # To improve performance, optionally mark the image as not writeable to
+    # pass by reference.
+    rgb.flags.writeable = False
+    return image, rgb, dsize
+
+
+# Runs the hand detection only on a padded crop around the hands found in the previous frames.
+# A full frame pass still runs every (full_every) frames, whenever no hands were found in the last frame and whenever
+# the crop finds fewer hands than the last pass did, or a hand that reaches the edge of the crop
+# The crops go to a detection of their own in static image mode. The tracking of mediapipe carries the hands from one
+# image to the next in image coordinates, which would be thrown off by switching between crops and full frames
+# A failed crop costs a second pass on the full frame, so after a failed crop the next (backoff) frames skip the crop,
+# doubling up to full_every while the crops keep failing
+# Has the same process/close interface as mp_hands.Hands and returns results in full frame coordinates
+class RoiHandDetector:
+    def __init__(self, hands, crop_hands, full_every=30, padding=0.5, edge_margin=0.02, min_size=160):
+        self.hands = hands
+        self.crop_hands = crop_hands
+
+        # Frames between two full frame passes
+        self.full_every = full_every
+
+        # Padding around the bounding box of the hands, relative to the size of the box
+        self.padding = padding
+
+        # Landmarks closer than this to the edge of the crop (relative to its size) mean the hand may be cut off
+        self.edge_margin = edge_margin
+
+        # Smallest crop (in pixels) so the palm detection still has something to work with
+        self.min_size = min_size
+
+        # Current crop (x0, y0, x1, y1) in pixels, or None if there are no hands to crop around
+        self.roi = None
+
+        # Number of hands found by the last pass
+        self.last_count = 0
+
+        self.frames_since_full = 0
+
+        # Failed crops in a row, and frames left before the next crop is tried
+        self.misses = 0
+        self.backoff = 0
+
+        # Counters for reporting
+        self.full_passes = 0
+        self.roi_passes = 0
+        self.failed_crops = 0
+
+    # Bounding box of all the landmarks of the results, in pixels
+    def landmark_box(self, results, width, height):
+        xs = [lm.x for hl in results.multi_hand_landmarks for lm in hl.landmark]
+        ys = [lm.y for hl in results.multi_hand_landmarks for lm in hl.landmark]
+        return min(xs) * width, min(ys) * height, max(xs) * width, max(ys) * height
+
+    # Move the crop so it contains the hands of the results with some padding
+    # The crop only moves when the hands get out of its inner part, so the hand detection sees a steady image
+    def update_roi(self, results, width, height):
+        if not results.multi_hand_landmarks:
+            self.roi = None
+            return
+
+        bx0, by0, bx1, by1 = self.landmark_box(results, width, height)
+        if self.roi is not None:
+            x0, y0, x1, y1 = self.roi
+            mx = (x1 - x0) * self.padding / (1 + 2 * self.padding)
+            my = (y1 - y0) * self.padding / (1 + 2 * self.padding)
+            if x0 + mx / 2 <= bx0 and bx1 <= x1 - mx / 2 and y0 + my / 2 <= by0 and by1 <= y1 - my / 2:
+                return
+
+        pad = max(bx1 - bx0, by1 - by0) * self.padding
+        cx, cy = (bx0 + bx1) / 2, (by0 + by1) / 2
+        half = max(max(bx1 - bx0, by1 - by0) / 2 + pad, self.min_size / 2)
+        x0, y0 = int(max(0, cx - half)), int(max(0, cy - half))
+        x1, y1 = int(min(width, cx + half)), int(min(height, cy + half))
+        self.roi = (x0, y0, x1, y1)
+
+    # Check if the crop found all the hands, with all their landmarks inside the crop
+    def confident(self, results):
+        if not results.multi_hand_landmarks or len(results.multi_hand_landmarks) < self.last_count:
+            return False
+        low, high = self.edge_margin, 1 - self.edge_margin
+        return all(low <= lm.x <= high and low <= lm.y <= high
+                   for hl in results.multi_hand_landmarks for lm in hl.landmark)
+
+    # Convert landmarks normalized to the crop to landmarks normalized to the full frame
+    def to_full_frame(self, results, width, height):
+        x0, y0, x1, y1 = self.roi
+        sx, sy = (x1 - x0) / width, (y1 - y0) / height
+        ox, oy = x0 / width, y0 / height
+        for hl in results.multi_hand_landmarks:
+            for lm in hl.landmark:
+                lm.x = ox + lm.x * sx
+                lm.y = oy + lm.y * sy
+        return results
+
+    def process(self, rgb):
+        height, width = rgb.shape[:2]
+
+        results = None
+        if self.backoff > 0:
+            self.backoff -= 1
+        elif self.roi is not None and self.last_count > 0 and self.frames_since_full < self.full_every:
+            x0, y0, x1, y1 = self.roi
+            crop = np.ascontiguousarray(rgb[y0:y1, x0:x1])
+            crop.flags.writeable = False
+            results = self.crop_hands.process(crop)
+            self.roi_passes += 1
+            self.frames_since_full += 1
+
+            if self.confident(results):
+                results = self.to_full_frame(results, width, height)
+                self.misses = 0
+            else:
+                results = None
+                self.failed_crops += 1
+                self.backoff = min(2 ** self.misses, self.full_every)
+                self.misses += 1
+
+        if results is None:
+            results = self.hands.process(rgb)
+            self.full_passes += 1
+            self.frames_since_full = 0
+
+        self.last_count = len(results.multi_handedness) if results.multi_handedness is not None else 0
+        self.update_roi(results, width, height)
+        return results
+
+    def close(self):
+        self.hands.close()
+        self.crop_hands.close()
+
+
+# Initialize hand detection, optionally restricted to the area around the last known hands
+# static_image_mode: run the full detection on every image instead of tracking the hands from the previous one, for a
+# detection shared between several cameras
+def create_hands(roi=False, static_image_mode=False):
+    hands = mp_hands.Hands(static_image_mode=static_image_mode, min_detection_confidence=0.5,
+                           min_tracking_confidence=0.5, max_num_hands=2)
+    if roi:
+        crop_hands = mp_hands.Hands(static_image_mode=True, min_detection_confidence=0.5, max_num_hands=2)
+        hands = RoiHandDetector(hands, crop_hands)
+    return hands
+
+
+# Cheap check, before the hand detection, of whether anything moved in the scene.
+# Frames are compared in a heavily downsampled grayscale version. The gate opens as soon as enough pixels changed, but
+# only closes after (hold) frames in a row with almost no change, so a hand pausing for a moment keeps being tracked
+class MotionGate:
+    def __init__(self, width=64, pixel_threshold=15, enter_ratio=0.005, exit_ratio=0.002, hold=15):
+        # Width of the downsampled frame
+        self.width = width
+
+        # Change in gray level for a pixel to count as changed
+        self.pixel_threshold = pixel_threshold
+
+        # Ratio of changed pixels needed to open the gate, and below which the scene is considered still
+        self.enter_ratio = enter_ratio
+        self.exit_ratio = exit_ratio
+
+        # Still frames in a row needed to close the gate
+        self.hold = hold
+
+        # Downsampled frame the next one is compared to. While the gate is closed it stays the frame the scene stopped
+        # moving at, so slow changes add up until they open the gate
+        self.reference = None
+
+        self.moving = True
+        self.still_frames = 0
+
+        # Number of frames each stage skipped because the scene was still
+        self.skipped = {"inference": 0, "tracking": 0, "surface": 0}
+
+    # Compare the frame with the reference. Return True if the frame has to be processed
+    def update(self, rgb):
+        height, width = rgb.shape[:2]
+        gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(gray, (self.width, max(1, height * self.width // width)), interpolation=cv2.INTER_AREA)
+
+        if self.reference is None:
+            self.reference = small
+            return self.moving
+
+        ratio = np.count_nonzero(cv2.absdiff(small, self.reference) > self.pixel_threshold) / small.size
+
+        if self.moving:
+            self.reference = small
+            if ratio < self.exit_ratio:
+                self.still_frames += 1
+                if self.still_frames >= self.hold:
+                    self.moving = False
+            else:
+                self.still_frames = 0
+        elif ratio > self.enter_ratio:
+            self.reference = small
+            self.moving = True
+            self.still_frames = 0
+
+        if not self.moving:
+            self.skipped["inference"] += 1
+            self.skipped["tracking"] += 1
+        return self.moving
+
+
+# Find the hands in the images
+def detect_hands(hands, rgb):
+    return hands.process(rgb)
+
+
+# Find the hands in the images unless the motion gate says the scene is still, in which case the last results are kept.
+# Return the results and whether the frame moved
+def gated_detect(hands, rgb, gate, last_results):
+    if gate is None or last_results is None:
+        moving = True
+        if gate is not None:
+            gate.update(rgb)
+    else:
+        moving = gate.update(rgb)
+
+    if moving:
+        return detect_hands(hands, rgb), True
+    return last_results, False
+
+
+# Run the tracker on the hand results and clean up the board if it is time to.
+# Return the BGR frame to draw on and the coordinates of the grabs and drops in this frame
+def track_frame(tracker, results, rgb, dsize, moving=True, gate=None):
+    # Draw the hand annotations on the image.
+    image = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+    lod, surface = tracker.track(results, dsize, image, moving)
+
+    if surface:
+        tracker.scan_surface(image)
+    elif gate is not None and not moving:
+        gate.skipped["surface"] += 1
+
+    return image, lod
+
+
+# Update the metrics that are kept as totals by the tracker, the motion gate and the pipeline
+def update_metrics(m, tracker, gate=None, pipeline=None):
+    m.gauge("hands", len(tracker.table))
+    if gate is not None:
+        m.set_count("skipped", gate.skipped["inference"])
+    if pipeline is not None:
+        m.set_count("dropped", sum(d for _, d in pipeline.drops()))
+
+
+# Print how many frames each stage skipped because of the motion gate
+def print_skipped(gate):
+    if gate is not None:
+        print("Skipped frames: " + ", ".join("{} {}".format(k, v) for k, v in gate.skipped.items()))
+
+
+# Draw the hands, the grabs and drops of this frame, the grid and the blocks onto the frame
+# The grid and the blocks come from the overlay cache if one is given
+def render_frame(image, results, board, lod, dsize, overlay=None):
+    # Draw the points on the hand
+    if results.multi_hand_landmarks:
+        for hand_landmarks in results.multi_hand_landmarks:
+            mp_drawing.draw_landmarks(image, hand_landmarks, mp_hands.HAND_CONNECTIONS)
+
+    # Draw circles to mark where blocks were placed in this frame
+    for d in lod:
+        x = int(d[0])
+        y = int(d[1])
+        image = cv2.circle(image, (x, y), 50, (255, 0, 0), 10)
+
+    # Draw the grid lines and the blocks
+    if overlay is not None:
+        image = overlay.apply(dsize, image, board)
+    else:
+        image = draw_board(dsize, image, board)
+
+    return image
+
+
+# Display the new augmented frame. Return False if the user asked to quit
+def show_frame(image):
+    cv2.imshow('MediaPipe Hands', image)
+    return not (cv2.waitKey(5) & 0xFF == 27)
+
+
+# Read the first frame and set up the board from the calibration file, or with the measurement prompt if measure is set
+# corners: corners of the board in the frame, to rectify it (see rectification.py). Saved with the calibration, so
+# later starts rectify the board without them
+# Return the board, the first frame, the Calibrator to offer the next frames to (see calibration.py) and the Rectifier
+# (None if the board isn't rectified), or only Nones if the source has no frames
+def setup_board(cap, source, calibration_path="calibration.json", measure=False, corners=None):
+    success, image = cap.read()
+    if not success:
+        return None, None, None, None
+
+    # Resize image
+    dsize = get_half_dimensions(image)
+
+    cal, calibrator = calibration.load_calibration(calibration_path, source, dsize)
+
+    # The frames are offered as read, but the board is scanned (and the corners given) in the mirrored view
+    calibrator.mirrored = True
+    if corners is not None:
+        cal.corners = corners
+
+        # Save the corners even if the file already had a calibration
+        calibrator.loaded = False
+
+    rectifier = cal.rectifier()
+    if measure:
+        width = prompt_measurement(cap, cv2.resize(image, dsize))
+        side_length = calibration.side_length_of(width)
+        if side_length is not None:
+            cal.measured_width = width
+            cal.set_side_length(side_length)
+
+        # Save the new measurement even if the file already had one
+        calibrator.loaded = False
+        calibrator.fixed_side_length = True
+    board = cal.board(cv2.resize(image, dsize) if rectifier is None else rectifier.blank())
+    return board, image, calibrator, rectifier
+
+
+def main(source="./testVideos/IMG_4362.MOV", roi=False, motion_gate=False, metrics_path=None, hud=False,
+         calibration_path="calibration.json", measure=False, corners=None):
     # For debugging purposes
     frame = 0
 
-    # Board for Minecraft conversion
-    board = None
-
     # Initialize hand detection
-    hands = mp_hands.Hands(min_detection_confidence=0.5, min_tracking_confidence=0.5, max_num_hands=2)
+    hands = create_hands(roi)
 
     # For webcam input:
-    cap = cv2.VideoCapture("./testVideos/IMG_4362.MOV")
+    cap = open_capture(source)
 
-    # List of hands
-    loh = []
+    # Board for Minecraft conversion
+    board, image, calibrator, rectifier = setup_board(cap, source, calibration_path, measure, corners)
+    if board is None:
+        print("Ignoring empty camera frame.")
+        hands.close()
+        cap.release()
+        return
 
-    # Whether a frame has no hands in it
-    no_hands = None
+    tracker = HandTracker(board, rectifier=rectifier)
 
-    # Trigger board cleanup when there are no hands for 10 consecutive frames
-    trigger = 10
+    # Skips the hand detection and board work while the scene is still
+    gate = MotionGate() if motion_gate else None
+    results = None
 
-    # Log of all the actions taken
-    log = []
+    # Grid and block marks, only redrawn when the board changes
+    overlay = OverlayCache(rectifier)
+
+    # Stage timers and counters, does nothing unless enabled
+    m = metrics.create_metrics(metrics_path, hud)
+    board.metrics = m
+
+    start = time.perf_counter()
     while cap.isOpened():
+        with m.stage("prepare"):
+            image, rgb, dsize = prepare_frame(image)
+        calibrator.offer(image)
+
+        with m.stage("hands"):
+            results, moving = gated_detect(hands, rgb, gate, results)
+        with m.stage("tracking"):
+            image, lod = track_frame(tracker, results, rgb, dsize, moving, gate)
+        with m.stage("render"):
+            image = render_frame(image, results, board, lod, dsize, overlay)
+
+        m.events(lod)
+        update_metrics(m, tracker, gate)
+        image = m.draw_hud(image)
+
+        with m.stage("display"):
+            if not show_frame(image):
+                break
+
+        frame += 1
+        now = time.perf_counter()
+        m.frame_done((now - start) * 1000)
+        start = now
+
         # Read the image
-        success, image = cap.read()
+        with m.stage("decode"):
+            success, image = cap.read()
 
         if not success:
             print("Ignoring empty camera frame.")
             # If loading a video, use 'break' instead of 'continue'.
             break
 
-        # Resize image
-        dsize = get_half_dimensions(image)
-        image = cv2.resize(image, dsize)
+    m.export()
+    print_skipped(gate)
 
-        # Set up board if not set up already
-        if board is None:
-            # Replace with board prompt
-            # board = contourUtil.Board(cv2.resize(image, dsize))
-            board = prompt_measurement(cap, image)
+    # Let the calibration finish saving if it is still measuring
+    calibrator.join(timeout=5)
 
-        # Flip the image horizontally for a later selfie-view display, and convert
-        # the BGR image to RGB.
-        image = cv2.cvtColor(cv2.flip(image, 1), cv2.COLOR_BGR2RGB)
-        # To improve performance, optionally mark the image as not writeable to
-        # pass by reference.
-        image.flags.writeable = False
+    # Close the hand and video code after video or stream is over
+    hands.close()
+    cap.release()
 
-        # Find the hands in the images
-        results = hands.process(image)
 
-        # Draw the hand annotations on the image.
-        image.flags.writeable = True
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+# Same as main, but the capture, hand inference, tracking and rendering run as separate stages connected by bounded
+# queues, so the slowest stage no longer holds back the others.
+# Webcams drop stale frames when a stage falls behind, video files never drop frames (see README)
+def main_pipelined(source="./testVideos/IMG_4362.MOV", drop_stale=None, maxsize=4, roi=False, motion_gate=False,
+                   metrics_path=None, hud=False, calibration_path="calibration.json", measure=False, corners=None):
+    if drop_stale is None:
+        drop_stale = is_webcam(source)
 
-        # List of coordinates where blocks have been grabbed or dropped
-        lod = []
+    # Initialize hand detection
+    hands = create_hands(roi)
 
-        # Get a copy of the hand info
-        cmh = deepcopy(results.multi_handedness)
-
-        # If hand info is none then there are no hands in the frame
-        if cmh is not None:
-            # Convert all hand point normalized coordinates to image coordinates.
-            cmhl = hlist_to_coords(results.multi_hand_landmarks, dsize)
-            ind = 0
-
-            # Iterate through the hands
-            while len(loh) > ind:
-                # Get current hand
-                temp_hand = loh[ind]
-
-                # See if any grab or drop occurred
-                x, y, release = temp_hand.print_toggle(cmh, cmhl, image)
-
-                # If a grab or drop occurred, update the board
-                if release is not None:
-                    if release:
-                        board.remove_single(x, y)
-                    else:
-                        board.add_single(x, y)
-
-                    # Log used to keep track of what was dropped and picked up
-                    log.append([x, y, release])
-
-                # If there was a grab or drop, add it to the list of coordinates to mark the location
-                if x is not None:
-                    lod.append((x, y))
-
-                # Update all the information about the hand from the last time to this frame
-                rem = temp_hand.update_everything(cmh, cmhl)
-
-                # If hand is successfully tracked and updated, remove from hand results for the frame
-                # Otherwise remove from list of hands we are tracking
-                if rem is not None:
-                    cmh.pop(rem)
-                    cmhl.pop(rem)
-                    ind += 1
-                else:
-                    loh.pop(ind)
-
-            # Add whatever remaining hands that didn't match any of the tracked hands to the tracked hands list
-            # In other words, we begin tracking the "new" hands (might be mistakenly considered new)
-            for index in range(0, len(cmh)):
-                temp_hand = hand(cmhl[index], cmh[index].classification._values[0].label, board)
-                loh.append(temp_hand)
-            no_hands = 0
+    cap = open_capture(source)
+
+    # The measurement prompt needs the GUI, so the board is set up before the stages start
+    board, first, calibrator, rectifier = setup_board(cap, source, calibration_path, measure, corners)
+    if board is None:
+        print("Ignoring empty camera frame.")
+        hands.close()
+        cap.release()
+        return
+
+    tracker = HandTracker(board, rectifier=rectifier)
+
+    # Skips the hand detection and board work while the scene is still
+    gate = MotionGate() if motion_gate else None
+    last_results = [None]
+
+    # Grid and block marks, only redrawn when the board changes
+    overlay = OverlayCache(rectifier)
+
+    # Stage timers and counters, does nothing unless enabled
+    m = metrics.create_metrics(metrics_path, hud)
+    board.metrics = m
+
+    # The first frame was already read to set up the board, so hand it out before reading from the capture
+    pending = [first]
+    counter = [0]
+
+    # Capture/decode stage
+    def read():
+        start = time.perf_counter()
+        if pending:
+            image = pending.pop()
         else:
-            # No hands are detected so remove all the currently tracked hands and update the no_hands state
-            # No hands state only begins keeping track after hands initially appear
-            loh = []
-            if no_hands is not None:
-                no_hands += 1
-
-        # Draw the points on the hand
-        if results.multi_hand_landmarks:
-            for hand_landmarks in results.multi_hand_landmarks:
-                mp_drawing.draw_landmarks(image, hand_landmarks, mp_hands.HAND_CONNECTIONS)
-
-        # Check if the no_hands state has started keeping track and is triggered
-        if no_hands is not None and no_hands > trigger:
-            # If triggered, reset the no hands state and clean up the surface
-            board.surface_level(image)
-            no_hands = 0
-
-        # Draw circles to mark where blocks were placed in this frame
-        for d in lod:
-            x = int(d[0])
-            y = int(d[1])
-            image = cv2.circle(image, (x, y), 50, (255, 0, 0), 10)
-
-        # Draw grid lines to the image
-        image = drawlines(dsize, image, board)
-
-        # Draw marks on where blocks are located at all times
-        for i in range(0, len(board.top)):
-            for j in range(0, len(board.top[0])):
-                if board.top[i][j] != 0:
-                    cx, cy = board.centers[i][j]
-                    image = cv2.circle(image, (cx, cy), 30, (0, 255, 0), 10)
-
-        # Display the new augmented frame.
-        cv2.imshow('MediaPipe Hands', image)
-        if cv2.waitKey(5) & 0xFF == 27:
+            with m.stage("decode"):
+                success, image = cap.read()
+            if not success:
+                return None
+        item = {"index": counter[0], "start": start}
+        counter[0] += 1
+        with m.stage("prepare"):
+            item["image"], item["rgb"], item["dsize"] = prepare_frame(image)
+        calibrator.offer(item["image"])
+        return item
+
+    # Hand inference stage
+    def infer(item):
+        with m.stage("hands"):
+            item["results"], item["moving"] = gated_detect(hands, item["rgb"], gate, last_results[0])
+        last_results[0] = item["results"]
+        return item
+
+    # Tracking and board update stage
+    def track(item):
+        with m.stage("tracking"):
+            item["image"], item["lod"] = track_frame(tracker, item["results"], item["rgb"], item["dsize"],
+                                                     item["moving"], gate)
+        return item
+
+    # Render stage
+    def render(item):
+        with m.stage("render"):
+            image = render_frame(item["image"], item["results"], board, item["lod"], item["dsize"], overlay)
+
+        # Report how far behind each stage is
+        txt = " ".join("{}:{}".format(name, depth) for name, depth in pipeline.depths())
+        image = cv2.putText(image, txt, (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (255, 0, 0), 1, cv2.LINE_AA)
+
+        m.events(item["lod"])
+        update_metrics(m, tracker, gate, pipeline)
+        image = m.draw_hud(image)
+
+        with m.stage("display"):
+            if not show_frame(image):
+                pipeline.stop()
+
+        # Time from the capture of the frame to its display
+        m.frame_done((time.perf_counter() - item["start"]) * 1000)
+        return item
+
+    pipeline = framePipeline.Pipeline(read, [("inference", infer), ("tracking", track), ("render", render)],
+                                      drop_stale=drop_stale, maxsize=maxsize)
+    try:
+        pipeline.run()
+
+        dropped = sum(d for _, d in pipeline.drops())
+        print("Processed {} frames, dropped {}".format(pipeline.stages[-1].processed, dropped))
+    finally:
+        # Also when a stage failed, in which case pipeline.run raised its exception
+        m.export()
+        print_skipped(gate)
+
+        # Let the calibration finish saving if it is still measuring
+        calibrator.join(timeout=5)
+
+        # Close the hand and video code after video or stream is over
+        hands.close()
+        cap.release()
+
+
+# Write one record as a line of JSON
+def write_record(out, record):
+    out.write(json.dumps(record) + "\n")
+
+
+# Process a single video without any GUI calls and stream its grab/release events and board snapshots to out.
+# Return the number of frames processed
+def process_headless(hands, path, side_length, trigger, out, gate=None, m=metrics.NULL_METRICS, corners=None):
+    cap = open_capture(path)
+
+    frame = 0
+    tracker = None
+    results = None
+    while cap.isOpened():
+        start = time.perf_counter()
+
+        # Read the image
+        with m.stage("decode"):
+            success, image = cap.read()
+        if not success:
             break
 
+        # Position of the frame in the video, in seconds
+        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+
+        with m.stage("prepare"):
+            image, rgb, dsize = prepare_frame(image)
+
+        # Set up board from the fixed calibration values instead of prompting for a measurement
+        if tracker is None:
+            rectifier = rectification.Rectifier(corners, dsize) if corners is not None else None
+            board = contourUtil.Board(image if rectifier is None else rectifier.blank(), side_length=side_length)
+            tracker = HandTracker(board, trigger=trigger, rectifier=rectifier)
+            tracker.board.metrics = m
+
+            # Consumers start from a snapshot, then only get the changes
+            write_record(out, dict(board.snapshot(), video=path, frame=frame, time=timestamp))
+            seq = board.seq
+
+        with m.stage("hands"):
+            results, moving = gated_detect(hands, rgb, gate, results)
+        with m.stage("tracking"):
+            lod, surface = tracker.track(results, dsize, None, moving)
+
+        for x, y, release in lod:
+            write_record(out, {"type": "event", "video": path, "frame": frame, "time": timestamp,
+                               "event": "grab" if release else "release", "x": x, "y": y})
+
+        if surface:
+            # The surface scan runs on the same mirrored frame the GUI mode uses
+            tracker.scan_surface(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+        elif gate is not None and not moving:
+            gate.skipped["surface"] += 1
+
+        # Changes of the board in this frame, with a snapshot now and then
+        for record in tracker.board.changes_since(seq):
+            write_record(out, dict(record, video=path, frame=frame, time=timestamp))
+        seq = tracker.board.seq
+
+        m.events(lod)
+        update_metrics(m, tracker, gate)
+        m.frame_done((time.perf_counter() - start) * 1000)
+
         frame += 1
 
-    # Close the hand and video code after video or stream is over
-    hands.close()
+    if tracker is not None:
+        write_record(out, {"type": "board", "video": path, "frame": frame, "time": None,
+                           "top": tracker.board.top.tolist()})
+
     cap.release()
+    return frame
+
+
+# Process recorded videos at full speed with fixed calibration values and no GUI.
+# Grab/release events and snapshots of the board are written to events_path as JSON lines
+def main_headless(paths, events_path="events.jsonl", side_length=36, trigger=10, roi=False, motion_gate=False,
+                  metrics_path=None, corners=None):
+    total_frames = 0
+    total_time = 0
+
+    # Stage timers and counters, does nothing unless enabled
+    m = metrics.create_metrics(metrics_path)
+    with open(events_path, "w") as out:
+        for path in paths:
+            # Each video gets its own hand detection so tracking doesn't carry over between videos
+            hands = create_hands(roi)
+
+            gate = MotionGate() if motion_gate else None
+
+            start = time.perf_counter()
+            frames = process_headless(hands, path, side_length, trigger, out, gate, m, corners)
+            elapsed = time.perf_counter() - start
+            hands.close()
+            print_skipped(gate)
+
+            fps = frames / elapsed if elapsed > 0 else 0
+            write_record(out, {"type": "summary", "video": path, "frames": frames, "seconds": elapsed, "fps": fps})
+            print("{}: {} frames in {:.1f}s ({:.1f} fps)".format(path, frames, elapsed, fps))
+
+            total_frames += frames
+            total_time += elapsed
+
+    m.export()
+
+    fps = total_frames / total_time if total_time > 0 else 0
+    print("Total: {} frames in {:.1f}s ({:.1f} fps)".format(total_frames, total_time, fps))
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="*", default=["./testVideos/IMG_4362.MOV"],
+                        help="video file, or webcam index. Headless mode accepts several videos")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="run capture, inference, tracking and rendering as separate stages")
+    parser.add_argument("--drop-stale", dest="drop_stale", action="store_true", default=None,
+                        help="drop stale frames when a stage falls behind (default for webcams)")
+    parser.add_argument("--no-drop", dest="drop_stale", action="store_false",
+                        help="never drop frames (default for video files)")
+    parser.add_argument("--queue-size", type=int, default=4, help="frames that can wait in front of each stage")
+    parser.add_argument("--headless", action="store_true",
+                        help="process the videos at full speed without any GUI and write the events as JSON lines")
+    parser.add_argument("--events", default="events.jsonl", help="output file of the headless mode")
+    parser.add_argument("--side-length", type=int, default=36, help="block side length used by the headless mode")
+    parser.add_argument("--trigger", type=int, default=10,
+                        help="frames without hands before the board surface is scanned again")
+    parser.add_argument("--roi", action="store_true",
+                        help="run the hand detection on a crop around the last known hands")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="skip the hand detection and board work while nothing moves in the scene")
+    parser.add_argument("--metrics", default=None,
+                        help="file rewritten every few seconds with the stage timers and counters "
+                             "(Prometheus textfile if it ends with .prom, JSON otherwise)")
+    parser.add_argument("--hud", action="store_true", help="draw the stage timers and counters on the frames")
+    parser.add_argument("--calibration", default="calibration.json",
+                        help="file the board calibration of every camera and resolution is kept in")
+    parser.add_argument("--measure", action="store_true",
+                        help="measure the blocks with the interactive prompt instead of using the calibration file")
+    parser.add_argument("--corners", type=rectification.parse_corners, default=None,
+                        help="corners of the board in the displayed frame to rectify it, as x1,y1,x2,y2,x3,y3,x4,y4 "
+                             "from the top left corner clockwise. Saved with the calibration")
+    args = parser.parse_args()
+
+    if args.headless:
+        main_headless(args.sources, events_path=args.events, side_length=args.side_length, trigger=args.trigger,
+                      roi=args.roi, motion_gate=args.motion_gate, metrics_path=args.metrics, corners=args.corners)
+    elif args.pipeline:
+        main_pipelined(args.sources[0], drop_stale=args.drop_stale, maxsize=args.queue_size, roi=args.roi,
+                       motion_gate=args.motion_gate, metrics_path=args.metrics, hud=args.hud,
+                       calibration_path=args.calibration, measure=args.measure, corners=args.corners)
+    else:
+        main(args.sources[0], roi=args.roi, motion_gate=args.motion_gate, metrics_path=args.metrics, hud=args.hud,
+             calibration_path=args.calibration, measure=args.measure, corners=args.corners)
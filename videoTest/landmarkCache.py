@@ -0,0 +1,310 @@
+import argparse
+import itertools
+import json
+import struct
+import time
+import cv2
+import numpy as np
+from videoTest import contourUtil
+from videoTest import grabDetection
+
+###############
+# DEFINITIONS #
+###############
+
+# landmark cache: binary file with the hands found in every frame of a recording, so the tracking and the board logic
+# can be run again without decoding the video or running the hand detection
+
+# File layout: MAGIC, then the length of the JSON header as a little endian uint32, then the JSON header (padded with
+# spaces to a multiple of 16 bytes), then one fixed size record per frame (see record_dtype). The records are read back
+# as a memory-mapped array
+
+# The surface scan needs the image, so while recording, the surface is scanned with the recorded side length once in
+# every run of frames without hands, like the live tracker does, and stored with the frame. The blocks only move while
+# hands are in view, so replay uses the scan of the run whenever the tracker asks for a surface scan in it, even if the
+# tracker asks earlier in the run than the scan was made
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# Parameters that can be swept by replay (see apply_params):
+# grabbing_params, distance_params, stability_timer_threshold, grace_period_timer_threshold, trigger
+
+# scan_after – hands-free frames in a row before the surface is scanned while recording, the same as the default
+# HandTracker.trigger. Runs shorter than that have no scan, so a replay with a lower trigger doesn't scan them either
+
+MAGIC = b"TCLM0001"
+
+# Handedness labels, stored as their index
+LABELS = ["Left", "Right"]
+
+
+# Data type of the record of one frame
+def record_dtype(max_hands, rows, cols):
+    return np.dtype([("frame", "<i8"),
+                     ("time", "<f8"),
+                     ("count", "u1"),
+                     ("handedness", "u1", (max_hands,)),
+                     ("landmarks", "<f4", (max_hands, 21, 2)),
+                     ("scanned", "u1"),
+                     ("there", "u1", ((rows * cols + 7) // 8,))])
+
+
+class LandmarkWriter:
+
+    def __init__(self, path, dsize, side_length, max_hands=2, video=None, fps=None):
+        # Geometry of the board, the same as contourUtil.Board builds for frames of size dsize
+        rows = dsize[1] // side_length + 1
+        cols = dsize[0] // side_length + 1
+
+        self.header = {"dsize": list(dsize), "side_length": side_length, "max_hands": max_hands, "rows": rows,
+                       "cols": cols, "video": video, "fps": fps}
+        self.dtype = record_dtype(max_hands, rows, cols)
+        self.max_hands = max_hands
+
+        text = json.dumps(self.header).encode("utf8")
+        text += b" " * (-(len(MAGIC) + 4 + len(text)) % 16)
+
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + struct.pack("<I", len(text)) + text)
+
+        # Record reused for every frame
+        self.record = np.zeros(1, dtype=self.dtype)
+
+    # Add the hands of one frame, and the there array of its surface scan if it was scanned
+    def write(self, frame, timestamp, det, there=None):
+        rec = self.record
+        rec[:] = 0
+        count = min(len(det), self.max_hands)
+
+        rec["frame"] = frame
+        rec["time"] = timestamp
+        rec["count"] = count
+        rec["handedness"][0, :count] = [LABELS.index(label) for label in det.handedness[:count]]
+        rec["landmarks"][0, :count] = det.landmarks[:count]
+
+        if there is not None:
+            rec["scanned"] = 1
+            rec["there"][0] = np.packbits(np.asarray(there, dtype=bool).ravel())
+
+        self.file.write(rec.tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+class LandmarkCache:
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a landmark cache".format(path))
+            length = struct.unpack("<I", f.read(4))[0]
+            self.header = json.loads(f.read(length).decode("utf8"))
+
+        self.dsize = tuple(self.header["dsize"])
+        self.side_length = self.header["side_length"]
+        self.rows = self.header["rows"]
+        self.cols = self.header["cols"]
+        self.dtype = record_dtype(self.header["max_hands"], self.rows, self.cols)
+
+        offset = len(MAGIC) + 4 + length
+        self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=offset)
+
+    def __len__(self):
+        return len(self.records)
+
+    # Index of the record of a frame number
+    def index_of_frame(self, frame):
+        return int(np.searchsorted(self.records["frame"], frame))
+
+    # Index of the first record at or after a time in the video, in seconds
+    def index_of_time(self, timestamp):
+        return int(np.searchsorted(self.records["time"], timestamp))
+
+    # Hands of the record at index i
+    def detections(self, i):
+        rec = self.records[i]
+        count = rec["count"]
+        labels = np.array([LABELS[h] for h in rec["handedness"][:count]], dtype="<U5")
+        return grabDetection.Detections(np.array(rec["landmarks"][:count]), labels)
+
+    # Index of the scanned record of the run of hands-free frames of every record, or -1 if there is none (the record
+    # has hands, or its run is too short to have been scanned)
+    def run_scans(self):
+        counts = self.records["count"]
+        scanned = self.records["scanned"]
+        scans = np.full(len(self), -1, dtype=np.int64)
+        start = 0
+        while start < len(self):
+            if counts[start] != 0:
+                start += 1
+                continue
+            end = start
+            while end < len(self) and counts[end] == 0:
+                end += 1
+            hits = np.flatnonzero(scanned[start:end])
+            if len(hits):
+                scans[start:end] = start + hits[0]
+            start = end
+        return scans
+
+    # there array of the surface scan of the record at index i, or None if the frame wasn't scanned
+    def there(self, i):
+        rec = self.records[i]
+        if not rec["scanned"]:
+            return None
+        bits = np.unpackbits(rec["there"])[:self.rows * self.cols]
+        return bits.reshape(self.rows, self.cols).astype(bool)
+
+    # Empty board with the geometry of the recording
+    def board(self):
+        return contourUtil.Board(np.zeros((self.dsize[1], self.dsize[0]), dtype=np.uint8),
+                                 side_length=self.side_length)
+
+
+# Run the hand detection over a video and save the hands of every frame to a landmark cache
+def record(video, path, side_length=36, roi=False, scan_after=10):
+    hands = grabDetection.create_hands(roi)
+    cap = grabDetection.open_capture(video)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+
+    writer = None
+    board = None
+    frame = 0
+    no_hands = 0
+    while cap.isOpened():
+        success, image = cap.read()
+        if not success:
+            break
+
+        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        image, rgb, dsize = grabDetection.prepare_frame(image)
+
+        if writer is None:
+            writer = LandmarkWriter(path, dsize, side_length, video=video, fps=fps)
+            board = contourUtil.Board(image, side_length=side_length)
+
+        det = grabDetection.Detections.from_results(grabDetection.detect_hands(hands, rgb), dsize)
+
+        # Frames without hands are the only ones the tracker can ask to scan, and the surface doesn't change until
+        # hands come back, so each run of them is scanned once
+        there = None
+        if len(det) == 0:
+            no_hands += 1
+            if no_hands == scan_after + 1:
+                board.surface_level(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+                there = board.there
+        else:
+            no_hands = 0
+
+        writer.write(frame, timestamp, det, there)
+        frame += 1
+
+    if writer is not None:
+        writer.close()
+    hands.close()
+    cap.release()
+    return frame
+
+
+# Set the tunable parameters of a tracker. Raise KeyError for a name that isn't one of them
+def apply_params(tracker, params):
+    table = tracker.table
+    for name, value in params.items():
+        if name in ("grabbing_params", "distance_params"):
+            setattr(table, name, list(value))
+        elif name in ("stability_timer_threshold", "grace_period_timer_threshold"):
+            setattr(table, name, value)
+        elif name == "trigger":
+            tracker.trigger = value
+        else:
+            raise KeyError("unknown tracker parameter {!r}".format(name))
+
+
+# Run the tracking and the board logic over a landmark cache.
+# dets: the detections of every record, if already loaded (see sweep)
+# Return the grab/release events as (frame, x, y, release) and the final board
+def replay(cache, params=None, dets=None):
+    tracker = grabDetection.HandTracker(cache.board())
+    tracker.table.verbose = False
+    apply_params(tracker, params or {})
+
+    frames = cache.records["frame"]
+    scans = cache.run_scans()
+    events = []
+    for i in range(len(cache)):
+        if dets is not None:
+            det = dets[i]
+            det.available[:] = True
+        else:
+            det = cache.detections(i)
+
+        lod, surface = tracker.track_detections(det)
+        for x, y, release in lod:
+            events.append((int(frames[i]), x, y, release))
+
+        if surface and scans[i] >= 0:
+            there = cache.there(scans[i])
+            if there is not None:
+                tracker.board.apply_there(there)
+            tracker.surface_stale = False
+
+    return events, tracker.board
+
+
+# Replay a landmark cache with every combination of the parameters in grid (name -> list of values).
+# Return a list of (params, events, board)
+def sweep(cache, grid):
+    # The hands of every frame are loaded once and shared by all the runs
+    dets = [cache.detections(i) for i in range(len(cache))]
+
+    names = sorted(grid)
+    results = []
+    for values in itertools.product(*[grid[n] for n in names]):
+        params = dict(zip(names, values))
+        events, board = replay(cache, params, dets)
+        results.append((params, events, board))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="save the hands of every frame of a video")
+    rec.add_argument("video")
+    rec.add_argument("cache")
+    rec.add_argument("--side-length", type=int, default=36, help="block side length used for the surface scans")
+    rec.add_argument("--roi", action="store_true", help="run the hand detection on a crop around the last hands")
+    rec.add_argument("--scan-after", type=int, default=10,
+                     help="hands-free frames in a row before the surface is scanned, like the tracker trigger")
+
+    rep = sub.add_parser("replay", help="run the tracking over a landmark cache")
+    rep.add_argument("cache")
+    rep.add_argument("--params", default="{}", help="JSON object of the parameters to use")
+
+    swp = sub.add_parser("sweep", help="replay a landmark cache with every combination of parameters")
+    swp.add_argument("cache")
+    swp.add_argument("grid", help='JSON object of parameter name -> list of values, e.g. {"trigger": [5, 10]}')
+    swp.add_argument("--out", default="sweep.jsonl", help="output file, as JSON lines")
+
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "record":
+        frames = record(args.video, args.cache, side_length=args.side_length, roi=args.roi,
+                        scan_after=args.scan_after)
+        print("Recorded {} frames in {:.1f}s".format(frames, time.perf_counter() - start))
+    elif args.command == "replay":
+        events, board = replay(LandmarkCache(args.cache), json.loads(args.params))
+        for frame, x, y, release in events:
+            print("{} {} at ({}, {})".format(frame, "Grabbed" if release else "Released", x, y))
+        print("Replayed in {:.2f}s".format(time.perf_counter() - start))
+    else:
+        results = sweep(LandmarkCache(args.cache), json.loads(args.grid))
+        with open(args.out, "w") as out:
+            for params, events, board in results:
+                grabDetection.write_record(out, {"params": params, "events": len(events), "top": board.top.tolist()})
+        print("Swept {} settings in {:.2f}s".format(len(results), time.perf_counter() - start))
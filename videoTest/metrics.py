@@ -0,0 +1,262 @@
+import bisect
+import json
+import os
+import threading
+import time
+import cv2
+
+###############
+# DEFINITIONS #
+###############
+
+# stage timer: time spent in one step of the frame loop (decode, hands, get_contours, ...), kept as a histogram
+
+# textfile: file rewritten every (interval) seconds with the current metrics, either as JSON or in the Prometheus
+# text exposition format (for the node exporter textfile collector). It is written to a temporary file first and then
+# renamed, so readers never see a half written file
+
+# threads: the stages of the pipeline (see framePipeline.py) share one Metrics. Stages, counters and gauges are added
+# under self.lock, and whatever goes through all of them (export, HUD) goes through a copy taken under it
+
+# When instrumentation is disabled, NULL_METRICS is used instead of a Metrics. All its methods do nothing, so the
+# frame loop doesn't need to check whether instrumentation is enabled
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# BUCKETS – upper bounds (in ms) of the histogram buckets
+# self.interval – seconds between two rewrites of the textfile
+
+BUCKETS = [1, 2, 5, 10, 20, 33, 50, 100, 200, 500, 1000]
+
+
+class Histogram:
+
+    def __init__(self):
+        # Number of observations in each bucket, the last one is for everything above the last bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+        self.last = 0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.sum += ms
+        self.last = ms
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    # Approximate percentile, as the upper bound of the bucket it falls in
+    def percentile(self, q):
+        target = q * self.count
+        seen = 0
+        for bound, c in zip(BUCKETS + [float("inf")], self.counts):
+            seen += c
+            if seen >= target and c:
+                return bound
+        return 0
+
+    def to_dict(self):
+        return {"count": self.count, "mean_ms": self.mean(), "last_ms": self.last, "p50_ms": self.percentile(0.5),
+                "p90_ms": self.percentile(0.9), "buckets": dict(zip([str(b) for b in BUCKETS] + ["inf"], self.counts))}
+
+
+class StageTimer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe((time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class Metrics:
+
+    # path: textfile to rewrite, or None to only keep the metrics in memory (for the HUD)
+    # fmt: "json" or "prometheus". By default, Prometheus if the path ends with .prom
+    def __init__(self, path=None, fmt=None, interval=5.0, hud=False):
+        self.path = path
+        if fmt is None:
+            fmt = "prometheus" if path is not None and path.endswith(".prom") else "json"
+        self.fmt = fmt
+        self.interval = interval
+        self.hud = hud
+
+        self.stages = {}
+        self.timers = {}
+        self.frame_time = Histogram()
+        self.lock = threading.Lock()
+
+        # Totals since the start: frames, dropped frames, skipped frames, grabs, releases
+        self.counters = {"frames": 0, "dropped": 0, "skipped": 0, "grabs": 0, "releases": 0}
+
+        # Current values: hands in view
+        self.gauges = {"hands": 0}
+
+        self.started = time.time()
+        self.last_export = time.time()
+        self.last_events = 0
+
+        # Grabs and releases per minute over the last export interval
+        self.event_rate = 0
+
+    # Timer of a stage, used as "with metrics.stage(name):"
+    def stage(self, name):
+        timer = self.timers.get(name)
+        if timer is None:
+            with self.lock:
+                timer = self.timers.get(name)
+                if timer is None:
+                    self.stages[name] = Histogram()
+                    timer = self.timers[name] = StageTimer(self.stages[name])
+        return timer
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Set a counter that is already kept as a total somewhere else (e.g. the drops of the pipeline)
+    def set_count(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    # Copies of the stages (as a list of (name, histogram)), counters and gauges
+    def snapshot(self):
+        with self.lock:
+            return list(self.stages.items()), dict(self.counters), dict(self.gauges)
+
+    # Count the grabs and releases of a frame
+    def events(self, lod):
+        for _, _, release in lod:
+            self.count("grabs" if release else "releases")
+
+    # Record the total time of a frame and rewrite the textfile if it is due
+    def frame_done(self, ms):
+        self.frame_time.observe(ms)
+        self.count("frames")
+
+        now = time.time()
+        if now - self.last_export >= self.interval:
+            events = self.counters["grabs"] + self.counters["releases"]
+            self.event_rate = (events - self.last_events) * 60 / (now - self.last_export)
+            self.last_events = events
+            self.last_export = now
+            self.export()
+
+    def to_dict(self):
+        stages, counters, gauges = self.snapshot()
+        return {"time": time.time(), "uptime": time.time() - self.started,
+                "stages": {name: h.to_dict() for name, h in stages},
+                "frame_time": self.frame_time.to_dict(), "counters": counters,
+                "gauges": gauges, "events_per_minute": self.event_rate}
+
+    # Metrics in the Prometheus text exposition format
+    def to_prometheus(self):
+        stages, counters, gauges = self.snapshot()
+        lines = ["# TYPE tangicraft_stage_seconds histogram"]
+        for name, h in stages + [("frame", self.frame_time)]:
+            metric = "tangicraft_frame_seconds" if name == "frame" else "tangicraft_stage_seconds"
+            label = "" if name == "frame" else 'stage="{}",'.format(name)
+            if name == "frame":
+                lines.append("# TYPE tangicraft_frame_seconds histogram")
+            seen = 0
+            for bound, c in zip(BUCKETS, h.counts):
+                seen += c
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(metric, label, bound / 1000, seen))
+            lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(metric, label, h.count))
+            lines.append("{}_sum{{{}}} {}".format(metric, label.rstrip(","), h.sum / 1000))
+            lines.append("{}_count{{{}}} {}".format(metric, label.rstrip(","), h.count))
+
+        for name, value in counters.items():
+            lines.append("# TYPE tangicraft_{}_total counter".format(name))
+            lines.append("tangicraft_{}_total {}".format(name, value))
+        for name, value in gauges.items():
+            lines.append("# TYPE tangicraft_{} gauge".format(name))
+            lines.append("tangicraft_{} {}".format(name, value))
+        lines.append("# TYPE tangicraft_events_per_minute gauge")
+        lines.append("tangicraft_events_per_minute {}".format(self.event_rate))
+        return "\n".join(lines) + "\n"
+
+    # Rewrite the textfile
+    def export(self):
+        if self.path is None:
+            return
+        text = self.to_prometheus() if self.fmt == "prometheus" else json.dumps(self.to_dict(), indent=2)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, self.path)
+
+    # Draw the last time of every stage and the counters in the corner of the frame
+    def draw_hud(self, img):
+        if not self.hud:
+            return img
+        stages, counters, gauges = self.snapshot()
+        lines = ["{} {:.1f}ms".format(name, h.last) for name, h in stages]
+        lines.append("frame {:.1f}ms hands {}".format(self.frame_time.last, gauges["hands"]))
+        lines.append("dropped {} skipped {}".format(counters["dropped"], counters["skipped"]))
+        for i, txt in enumerate(lines):
+            img = cv2.putText(img, txt, (10, 40 + 15 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 255), 1, cv2.LINE_AA)
+        return img
+
+
+class NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullMetrics:
+
+    hud = False
+
+    def stage(self, name):
+        return NULL_TIMER
+
+    def count(self, name, n=1):
+        pass
+
+    def set_count(self, name, value):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def events(self, lod):
+        pass
+
+    def frame_done(self, ms):
+        pass
+
+    def export(self):
+        pass
+
+    def draw_hud(self, img):
+        return img
+
+
+NULL_TIMER = NullTimer()
+NULL_METRICS = NullMetrics()
+
+
+# Metrics for the given options, or NULL_METRICS if instrumentation is disabled
+def create_metrics(path=None, hud=False, fmt=None, interval=5.0):
+    if path is None and not hud:
+        return NULL_METRICS
+    return Metrics(path, fmt=fmt, interval=interval, hud=hud)
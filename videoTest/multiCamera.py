@@ -0,0 +1,344 @@
+import argparse
+import threading
+import time
+import cv2
+from videoTest import grabDetection
+from videoTest import metrics
+
+###############
+# DEFINITIONS #
+###############
+
+# station: one camera (or video) with its own Board, hand tracker, calibration and motion gate. All the stations of a
+# classroom are served by one process
+
+# inference worker: thread with a hand detection of its own, so only (--workers) hand detections are loaded however
+# many cameras there are. Every station is pinned to one worker, which runs the hand detection and then the tracking
+# of the station on its frames. A worker serving a single station tracks the hands from one frame to the next like a
+# single camera does. A worker serving several stations runs its detection in static image mode, because its
+# consecutive frames come from different cameras
+
+# scheduler: hands the frames of the stations to their workers, in round-robin order among the stations of a worker so
+# a busy camera can't starve the other ones. Every station has a single slot: live cameras replace the waiting frame
+# with the newest one (drop stale), videos wait until it was taken. A station only has one worker, so its frames are
+# tracked in order
+
+# failure: an exception in a worker or a capture thread stops the whole service, and Service.run raises it again once
+# the threads have finished
+
+# latency: time from reading a frame from the camera to the end of its tracking, per station
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# --workers – inference workers shared by the stations
+# --report-seconds – seconds between two latency reports
+
+
+class Station:
+
+    def __init__(self, index, source, calibration_path="calibration.json", motion_gate=False, show=False):
+        self.index = index
+        self.name = "cam{}".format(index)
+        self.source = source
+        self.live = grabDetection.is_webcam(source)
+        self.show = show
+
+        self.cap = grabDetection.open_capture(source)
+        board, self.first, self.calibrator, rectifier = grabDetection.setup_board(self.cap, source, calibration_path)
+        self.board = board
+        self.tracker = None if board is None else grabDetection.HandTracker(board, rectifier=rectifier)
+        self.overlay = grabDetection.OverlayCache(rectifier)
+
+        self.gate = grabDetection.MotionGate() if motion_gate else None
+        self.results = None
+
+        # Latency of every frame, and frames read, tracked and dropped because a newer one came in
+        self.latency = metrics.Histogram()
+        self.frames = 0
+        self.processed = 0
+        self.dropped = 0
+
+        # Last rendered frame, shown by the main thread
+        self.rendered = None
+
+        # Last change set of the board written to the events file. -1 so the first write starts with a snapshot
+        self.seq = -1
+
+        self.finished = self.tracker is None
+
+    # Read the next frame. Return a work item, or None once the source runs out of frames
+    def read(self):
+        start = time.perf_counter()
+        if self.first is not None:
+            image, self.first = self.first, None
+        else:
+            success, image = self.cap.read()
+            if not success:
+                return None
+
+        image, rgb, dsize = grabDetection.prepare_frame(image)
+        self.calibrator.offer(image)
+        item = {"frame": self.frames, "start": start, "time": time.time(), "image": image, "rgb": rgb, "dsize": dsize}
+        self.frames += 1
+        return item
+
+    # Hand detection and tracking of one frame, run by a worker with its hand detection. Return the grabs and drops of
+    # the frame and whether the surface was scanned
+    def process(self, hands, item):
+        self.results, moving = grabDetection.gated_detect(hands, item["rgb"], self.gate, self.results)
+        image, lod = grabDetection.track_frame(self.tracker, self.results, item["rgb"], item["dsize"], moving,
+                                               self.gate)
+        if self.show:
+            self.rendered = grabDetection.render_frame(image, self.results, self.board, lod, item["dsize"],
+                                                       self.overlay)
+
+        self.latency.observe((time.perf_counter() - item["start"]) * 1000)
+        self.processed += 1
+        return lod
+
+    # release: whether the capture can be released, which isn't the case while a capture thread may still be reading
+    def close(self, release=True):
+        if self.calibrator is not None:
+            self.calibrator.join(timeout=5)
+        if release:
+            self.cap.release()
+
+
+class Scheduler:
+
+    # assigned: indices of the stations of every worker
+    def __init__(self, stations, assigned):
+        self.stations = stations
+        self.assigned = assigned
+        self.condition = threading.Condition()
+
+        # Waiting frame of every station, and whether its worker is processing a frame of the station
+        self.slots = [None] * len(stations)
+        self.busy = [False] * len(stations)
+
+        # Position in assigned the round-robin search of every worker starts from
+        self.next = [0] * len(assigned)
+
+        self.stopped = False
+
+    # Hand a frame of a station to the workers. Live stations replace the waiting frame, videos wait for it to be taken
+    def put(self, index, item):
+        with self.condition:
+            station = self.stations[index]
+            while not station.live and self.slots[index] is not None and not self.stopped:
+                self.condition.wait()
+            if self.slots[index] is not None:
+                station.dropped += 1
+            self.slots[index] = item
+            self.condition.notify_all()
+
+    # Take the next frame of a worker in round-robin order among its stations that have one waiting.
+    # Return (index, item), or None once the scheduler is stopped
+    def get(self, worker):
+        with self.condition:
+            assigned = self.assigned[worker]
+            n = len(assigned)
+            while True:
+                if self.stopped:
+                    return None
+                for k in range(n):
+                    position = (self.next[worker] + k) % n
+                    index = assigned[position]
+                    if self.slots[index] is not None and not self.busy[index]:
+                        item = self.slots[index]
+                        self.slots[index] = None
+                        self.busy[index] = True
+                        self.next[worker] = (position + 1) % n
+                        self.condition.notify_all()
+                        return index, item
+                self.condition.wait()
+
+    # Mark the frame of a station as processed
+    def done(self, index):
+        with self.condition:
+            self.busy[index] = False
+            self.condition.notify_all()
+
+    # Whether a station has no frame waiting or in a worker
+    def idle(self, index):
+        with self.condition:
+            return self.slots[index] is None and not self.busy[index]
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+class Service:
+
+    def __init__(self, sources, workers=2, events_path="events.jsonl", calibration_path="calibration.json",
+                 motion_gate=False, show=False):
+        self.stations = [Station(i, source, calibration_path, motion_gate, show) for i, source in enumerate(sources)]
+        self.show = show
+
+        # Stations that have frames, pinned to the workers in turn. There are never more workers than stations
+        active = [station.index for station in self.stations if not station.finished]
+        self.num_workers = max(1, min(workers, len(active)))
+        assigned = [active[i::self.num_workers] for i in range(self.num_workers)]
+        self.scheduler = Scheduler(self.stations, assigned)
+
+        # Hand detection of every worker
+        self.hands = [grabDetection.create_hands(static_image_mode=len(stations) > 1) for stations in assigned]
+
+        self.out = open(events_path, "w")
+        self.out_lock = threading.Lock()
+
+        self.threads = []
+
+        # Capture thread of every station that has one, and thread of every worker
+        self.captures = {}
+        self.workers = []
+
+        # First exception of a worker or a capture thread
+        self.error = None
+
+    # Stop the service because of an exception in one of its threads
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.scheduler.stop()
+
+    # Capture thread of a station
+    def capture(self, station):
+        try:
+            while not self.scheduler.stopped:
+                item = station.read()
+                if item is None:
+                    break
+                self.scheduler.put(station.index, item)
+        except Exception as e:
+            self.fail(e)
+            return
+
+        # Wait for the last frame to be tracked before calling the station finished
+        while not self.scheduler.idle(station.index) and not self.scheduler.stopped:
+            time.sleep(0.01)
+        station.finished = True
+
+    # Inference worker thread. An exception stops the service instead of leaving the capture threads waiting
+    def work(self, worker):
+        hands = self.hands[worker]
+        try:
+            while True:
+                task = self.scheduler.get(worker)
+                if task is None:
+                    break
+                index, item = task
+                station = self.stations[index]
+                try:
+                    lod = station.process(hands, item)
+                    self.write_events(station, item, lod)
+                finally:
+                    self.scheduler.done(index)
+        except Exception as e:
+            self.fail(e)
+
+    # Write the grabs and drops of a frame and the changes of the board since the last frame of the station
+    def write_events(self, station, item, lod):
+        records = station.board.changes_since(station.seq)
+        if not lod and not records:
+            return
+        station.seq = station.board.seq
+
+        tags = {"camera": station.name, "source": station.source, "frame": item["frame"], "time": item["time"]}
+        with self.out_lock:
+            for x, y, release in lod:
+                grabDetection.write_record(self.out, dict(tags, type="event", event="grab" if release else "release",
+                                                          x=x, y=y))
+            for record in records:
+                grabDetection.write_record(self.out, dict(record, **tags))
+
+    def start(self):
+        for station in self.stations:
+            if not station.finished:
+                t = threading.Thread(target=self.capture, args=(station,), name=station.name, daemon=True)
+                self.captures[station.index] = t
+                self.threads.append(t)
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self.work, args=(i,), name="hands-{}".format(i), daemon=True)
+            self.workers.append(t)
+            self.threads.append(t)
+        for t in self.threads:
+            t.start()
+
+    # Print the frame rate, latency percentiles and dropped frames of every station
+    def report(self, elapsed):
+        for station in self.stations:
+            h = station.latency
+            print("{}: {:.1f} fps, latency mean {:.0f}ms p50 {}ms p90 {}ms, dropped {}".format(
+                station.name, station.processed / elapsed if elapsed > 0 else 0, h.mean(), h.percentile(0.5),
+                h.percentile(0.9), station.dropped))
+
+    # Serve all the stations until every source runs out of frames or the user quits. Return the seconds it ran for.
+    # Raise the first exception of a worker or a capture thread once the threads have finished
+    def run(self, report_seconds=10):
+        start = time.perf_counter()
+        last_report = start
+        self.start()
+        try:
+            while not all(station.finished for station in self.stations) and not self.scheduler.stopped:
+                if self.show:
+                    # Windows can only be shown from the main thread
+                    for station in self.stations:
+                        if station.rendered is not None:
+                            cv2.imshow("TangiCraft " + station.name, station.rendered)
+                    if cv2.waitKey(5) & 0xFF == 27:
+                        break
+                else:
+                    time.sleep(0.05)
+
+                now = time.perf_counter()
+                if now - last_report >= report_seconds:
+                    self.report(now - start)
+                    last_report = now
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+        return time.perf_counter() - start
+
+    def stop(self):
+        self.scheduler.stop()
+        for t in self.threads:
+            t.join(timeout=5)
+        for station in self.stations:
+            # A capture thread still stuck in cap.read() keeps its capture, it goes away with the process
+            t = self.captures.get(station.index)
+            station.close(release=t is None or not t.is_alive())
+
+        # Same for a worker still stuck in its hand detection
+        for i, hands in enumerate(self.hands):
+            if i >= len(self.workers) or not self.workers[i].is_alive():
+                hands.close()
+        self.out.close()
+
+
+def main(sources, workers=2, events_path="events.jsonl", calibration_path="calibration.json", motion_gate=False,
+         show=False, report_seconds=10):
+    service = Service(sources, workers, events_path, calibration_path, motion_gate, show)
+    elapsed = service.run(report_seconds)
+    print("Served {} cameras for {:.1f}s".format(len(sources), elapsed))
+    service.report(elapsed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sources", nargs="+", help="webcam indices or video files, one per station")
+    parser.add_argument("--workers", type=int, default=2, help="hand detection workers shared by the stations")
+    parser.add_argument("--events", default="events.jsonl", help="output file for the events of all the stations")
+    parser.add_argument("--calibration", default="calibration.json", help="board calibration file (see calibration.py)")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="skip the hand detection and board work of a station while nothing moves in front of it")
+    parser.add_argument("--show", action="store_true", help="show a window for every station")
+    parser.add_argument("--report-seconds", type=float, default=10, help="seconds between two latency reports")
+    args = parser.parse_args()
+
+    main(args.sources, args.workers, args.events, args.calibration, args.motion_gate, args.show, args.report_seconds)
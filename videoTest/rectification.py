@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+
+###############
+# DEFINITIONS #
+###############
+
+# rectification: undoing the perspective of a camera that doesn't look straight down at the board, so the grid of
+# contourUtil.Board lines up with the blocks again. The four corners of the board in the frame are mapped to the
+# corners of an upright rectangle (the rectified board) by a homography
+
+# frame coordinates: pixels of the frame as it is displayed (half size and mirrored, see grabDetection.prepare_frame).
+# The corners and the hand coordinates are in frame coordinates
+
+# board coordinates: pixels of the rectified board. The Board, its surface scans and its index sets use board
+# coordinates
+
+# remap maps: for every pixel of the rectified board, the frame pixel it comes from. They are computed once from the
+# homography and converted to the fixed-point format of cv2.remap, so warping a frame is a single lookup per pixel
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# size – size of the rectified board. By default the longest opposite sides of the corners, so the board keeps about
+# the resolution it has in the frame
+
+
+# Parse corners given as "x1,y1,x2,y2,x3,y3,x4,y4" (top left, top right, bottom right, bottom left)
+def parse_corners(text):
+    values = [float(v) for v in text.split(",")]
+    if len(values) != 8:
+        raise ValueError("expected 8 comma separated values for the 4 corners, got {}".format(len(values)))
+    return np.array(values, dtype=np.float32).reshape(4, 2)
+
+
+# Size of the rectified board for corners (top left, top right, bottom right, bottom left)
+def board_size(corners):
+    tl, tr, br, bl = corners
+    width = max(np.linalg.norm(tr - tl), np.linalg.norm(br - bl))
+    height = max(np.linalg.norm(bl - tl), np.linalg.norm(br - tr))
+    return int(round(width)), int(round(height))
+
+
+# Remap maps of a rectified board of the given size, from the homography that maps board coordinates to frame
+# coordinates
+def remap_maps(inverse, size):
+    width, height = size
+    xs, ys = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    points = np.stack([xs, ys], axis=-1).reshape(-1, 1, 2)
+    source = cv2.perspectiveTransform(points, inverse).reshape(height, width, 2)
+    return cv2.convertMaps(source, None, cv2.CV_16SC2)
+
+
+class Rectifier:
+
+    # corners: the board corners in frame coordinates (top left, top right, bottom right, bottom left)
+    # dsize: size of the frames
+    def __init__(self, corners, dsize, size=None):
+        self.corners = np.asarray(corners, dtype=np.float32).reshape(4, 2)
+        self.dsize = tuple(dsize)
+        self.size = tuple(size) if size is not None else board_size(self.corners)
+
+        width, height = self.size
+        target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+
+        # Frame coordinates -> board coordinates, and back
+        self.homography = cv2.getPerspectiveTransform(self.corners, target)
+        self.inverse = np.linalg.inv(self.homography)
+
+        self.map1, self.map2 = remap_maps(self.inverse, self.size)
+
+    # Rectified board of a frame
+    def warp(self, image):
+        return cv2.remap(image, self.map1, self.map2, cv2.INTER_LINEAR)
+
+    # Image of the rectified board (e.g. the grid overlay) put back into frame coordinates
+    def unwarp(self, image):
+        return cv2.warpPerspective(image, self.homography, self.dsize, flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+
+    # Board coordinates of an array of (x, y) frame coordinates, all at once
+    def to_board(self, points):
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(points, self.homography).reshape(-1, 2)
+
+    # Frame coordinates of an array of (x, y) board coordinates
+    def to_frame(self, points):
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(points, self.inverse).reshape(-1, 2)
+
+    # Empty image of the size of the rectified board, to set up a Board with
+    def blank(self):
+        return np.zeros((self.size[1], self.size[0], 3), dtype=np.uint8)
@@ -1,4 +1,5 @@
 import cv2
+import numpy as np
 
 
 class ShapeDetector:
@@ -6,6 +7,19 @@ class ShapeDetector:
     def __init__(self):
         pass
 
+    # Contours of cnts that are squares or rectangles, as a list of (contour, (x, y, w, h)) with the bounding box of
+    # the contour. Same as checking detect on every contour, but contours that can't be a square or a rectangle are
+    # left out first, all at once (see candidates)
+    # side_length, max_ratio: also leave out contours with w / side_length > max_ratio
+    def quadrilaterals(self, cnts, side_length=None, max_ratio=None):
+        index, boxes = candidates(cnts)
+        if max_ratio is not None:
+            keep = boxes[:, 2] / side_length <= max_ratio
+            index, boxes = index[keep], boxes[keep]
+
+        return [(cnts[i], box) for i, box in zip(index.tolist(), boxes.tolist())
+                if self.detect(cnts[i]) in ('rectangle', 'square')]
+
     def detect(self, c):
         # initialize the shape name and approximate the contour
         shape = "unidentified"
@@ -32,4 +46,30 @@ class ShapeDetector:
         else:
             shape = "circle"
         # return the name of the shape
-        return shape
\ No newline at end of file
+        return shape
+
+
+# Bounding boxes (x, y, w, h) of all the contours at once, same as cv2.boundingRect on each contour
+def bounding_boxes(cnts):
+    if len(cnts) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    points = np.concatenate(cnts).reshape(-1, 2)
+    starts = np.cumsum([0] + [len(c) for c in cnts[:-1]])
+    low = np.minimum.reduceat(points, starts)
+    high = np.maximum.reduceat(points, starts)
+    return np.hstack([low, high - low + 1]).astype(np.int64)
+
+
+# Leave out the contours that detect can't call a square or a rectangle, using only the number of points and the
+# bounding box of every contour:
+# - fewer than 4 points can't be approximated by 4 vertices
+# - a bounding box 1 pixel wide or high means all the points are on a line, which is approximated by 2 vertices
+# Return the indices of the contours left and their bounding boxes
+def candidates(cnts):
+    counts = np.fromiter(map(len, cnts), dtype=np.int64, count=len(cnts))
+    index = np.flatnonzero(counts >= 4)
+
+    boxes = bounding_boxes([cnts[i] for i in index])
+    keep = (boxes[:, 2] > 1) & (boxes[:, 3] > 1)
+    return index[keep], boxes[keep]
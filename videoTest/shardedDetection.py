@@ -0,0 +1,192 @@
+import argparse
+import math
+import multiprocessing
+import time
+import cv2
+from videoTest import contourUtil
+from videoTest import grabDetection
+
+###############
+# DEFINITIONS #
+###############
+
+# segment: range of frames [start, end) of a recording processed by one worker. Only events of frames inside the range
+# are kept
+
+# overlap: frames right before the start of a segment that the worker processes without keeping their events. They let
+# the hand detection and the hand tracker pick up the hands that are already in view at the start of the segment, so
+# the tracking state at the boundary matches what a single pass over the whole recording would have
+
+#########################
+# ADJUSTABLE PARAMETERS #
+#########################
+
+# segment_seconds – length of a segment
+# overlap_seconds – length of the overlap before each segment
+
+# Hand detection of the worker process, created once per process by init_worker
+worker_hands = None
+
+
+# Give every worker process its own hand detection
+def init_worker():
+    global worker_hands
+    worker_hands = grabDetection.create_hands()
+
+
+# Split a recording of num_frames frames into segments. Return a list of (first, start, end) where first is the first
+# frame of the overlap
+def split_segments(num_frames, segment_frames, overlap_frames):
+    segments = []
+    start = 0
+    while start < num_frames:
+        end = min(start + segment_frames, num_frames)
+        segments.append((max(0, start - overlap_frames), start, end))
+        start = end
+    return segments
+
+
+# Process one segment of a recording. Return the events and the surface scans of the segment, plus the first frame in
+# the segment where hands were seen (None if there were none)
+def process_segment(task):
+    path, index, first, start, end, side_length, trigger = task
+
+    cap = grabDetection.open_capture(path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+
+    tracker = None
+    events = []
+    surfaces = []
+    first_hands = None
+
+    frame = first
+    while frame < end:
+        success, image = cap.read()
+        if not success:
+            break
+
+        timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+
+        image, rgb, dsize = grabDetection.prepare_frame(image)
+
+        if tracker is None:
+            tracker = grabDetection.HandTracker(contourUtil.Board(image, side_length=side_length), trigger=trigger)
+
+            # The first segment starts like a single pass would. The other ones assume hands have been seen already,
+            # merge_segments drops their surface scans if that's not the case
+            if index > 0:
+                tracker.no_hands = 0
+
+        results = grabDetection.detect_hands(worker_hands, rgb)
+        lod = tracker.update(results, dsize, None)
+
+        surface = tracker.surface_due()
+        if surface:
+            tracker.scan_surface(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+
+        # Frames of the overlap only warm up the tracking state
+        if frame >= start:
+            if first_hands is None and results.multi_handedness is not None:
+                first_hands = frame
+
+            for x, y, release in lod:
+                events.append({"type": "event", "video": path, "frame": frame, "time": timestamp,
+                               "event": "grab" if release else "release", "x": x, "y": y})
+
+            if surface:
+                surfaces.append({"frame": frame, "there": tracker.board.there.copy()})
+
+        frame += 1
+
+    cap.release()
+    return {"index": index, "events": events, "surfaces": surfaces, "first_hands": first_hands, "frames": frame - start}
+
+
+# Merge the results of all the segments of a recording into one ordered event log and one final board
+def merge_segments(results, board):
+    results = sorted(results, key=lambda r: r["index"])
+
+    # A single pass only starts scanning the surface once hands have appeared, so scans before that are dropped
+    seen = [r["first_hands"] for r in results if r["first_hands"] is not None]
+    first_hands = min(seen) if seen else None
+
+    # Actions in frame order. Within a frame, the grabs and releases come before the surface scan like in HandTracker
+    actions = []
+    for r in results:
+        for e in r["events"]:
+            actions.append((e["frame"], 0, e))
+        for sfc in r["surfaces"]:
+            if first_hands is not None and sfc["frame"] > first_hands:
+                actions.append((sfc["frame"], 1, sfc))
+    actions.sort(key=lambda a: (a[0], a[1]))
+
+    log = []
+    for _, kind, action in actions:
+        if kind == 0:
+            if action["event"] == "grab":
+                board.remove_single(action["x"], action["y"])
+            else:
+                board.add_single(action["x"], action["y"])
+            log.append(action)
+        else:
+            board.apply_there(action["there"])
+
+    return log, board
+
+
+# Process a recording with a pool of worker processes. Return the ordered event log and the final board
+def process_sharded(path, workers=None, segment_seconds=30, overlap_seconds=1, side_length=36, trigger=10):
+    cap = grabDetection.open_capture(path)
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    success, image = cap.read()
+    cap.release()
+    if not success:
+        return [], None
+
+    image, _, _ = grabDetection.prepare_frame(image)
+    board = contourUtil.Board(image, side_length=side_length)
+
+    segment_frames = max(1, int(segment_seconds * fps))
+    overlap_frames = int(math.ceil(overlap_seconds * fps))
+    tasks = [(path, i, first, start, end, side_length, trigger)
+             for i, (first, start, end) in enumerate(split_segments(num_frames, segment_frames, overlap_frames))]
+
+    with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+        results = pool.map(process_segment, tasks, chunksize=1)
+
+    return merge_segments(results, board)
+
+
+def main(paths, events_path="events.jsonl", workers=None, segment_seconds=30, overlap_seconds=1, side_length=36,
+         trigger=10):
+    with open(events_path, "w") as out:
+        for path in paths:
+            start = time.perf_counter()
+            log, board = process_sharded(path, workers, segment_seconds, overlap_seconds, side_length, trigger)
+            elapsed = time.perf_counter() - start
+
+            for record in log:
+                grabDetection.write_record(out, record)
+
+            if board is not None:
+                grabDetection.write_record(out, {"type": "board", "video": path, "frame": None, "time": None,
+                                                 "top": board.top.tolist()})
+
+            print("{}: {} events in {:.1f}s".format(path, len(log), elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("videos", nargs="+", help="recorded videos to process")
+    parser.add_argument("--events", default="events.jsonl", help="output file for the events, as JSON lines")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--segment-seconds", type=float, default=30, help="length of the segment of each task")
+    parser.add_argument("--overlap-seconds", type=float, default=1, help="warm-up before each segment")
+    parser.add_argument("--side-length", type=int, default=36, help="block side length")
+    parser.add_argument("--trigger", type=int, default=10,
+                        help="frames without hands before the board surface is scanned again")
+    args = parser.parse_args()
+
+    main(args.videos, args.events, args.workers, args.segment_seconds, args.overlap_seconds, args.side_length,
+         args.trigger)